@@ -10,15 +10,15 @@
 Description : Item-based Collaborative filtering.
 """
 import collections
-from operator import itemgetter
-
-import math
+import heapq
 
 from collections import defaultdict
 
+import evaluation
+import instrument
 import similarity
 import utils
-from utils import LogTime
+from sparse_matrix import TopKNeighbors
 
 
 class ItemBasedCF:
@@ -27,9 +27,13 @@ class ItemBasedCF:
     Top-N recommendation.
     """
 
-    def __init__(self, k_sim_movie=20, n_rec_movie=10, use_iuf_similarity=False, save_model=True):
+    def __init__(self, k_sim_movie=20, n_rec_movie=10, use_iuf_similarity=False, save_model=True,
+                 use_sparse_engine=True, keep_similarity_matrix=True):
         """
         Init UserBasedCF with n_sim_user and n_rec_movie.
+        :param use_sparse_engine: calculate similarity with sparse matrices instead of dicts.
+        :param keep_similarity_matrix: keep and save the full movie similarity matrix.
+                                       recommend only needs the top-K similar movies index.
         :return: None
         """
         print("ItemBasedCF start...\n")
@@ -38,6 +42,14 @@ class ItemBasedCF:
         self.trainset = None
         self.save_model = save_model
         self.use_iuf_similarity = use_iuf_similarity
+        self.use_sparse_engine = use_sparse_engine
+        self.keep_similarity_matrix = keep_similarity_matrix
+        self.movie_sim_mat = None
+        self.movie_neighbors = None
+        # co-occurrence counts of movies, recovered by the first partial_fit.
+        self.movie_cooccurrence = None
+        # trainset is the object passed to fit until partial_fit copies it.
+        self.owns_trainset = False
 
     def fit(self, trainset):
         """
@@ -45,28 +57,99 @@ class ItemBasedCF:
         :param trainset: train dataset
         :return: None
         """
-        model_manager = utils.ModelManager()
+        model_manager = utils.ModelManager(params=self.cache_params(), trainset=trainset)
+        sim_mat_name = 'movie_sim_mat-iif' if self.use_iuf_similarity else 'movie_sim_mat'
+        self.trainset = trainset
+        self.movie_sim_mat = None
+        self.movie_cooccurrence = None
+        self.owns_trainset = False
         try:
-            self.movie_sim_mat = model_manager.load_model(
-                'movie_sim_mat-iif' if self.use_iuf_similarity else 'movie_sim_mat')
             self.movie_popular = model_manager.load_model('movie_popular')
             self.movie_count = model_manager.load_model('movie_count')
-            self.trainset = model_manager.load_model('trainset')
+            try:
+                self.movie_neighbors = model_manager.load_model(self.neighbors_name())
+            except OSError:
+                self.movie_sim_mat = model_manager.load_model(sim_mat_name)
+                self.fit_neighbors(model_manager)
+            if self.keep_similarity_matrix and self.movie_sim_mat is None:
+                self.movie_sim_mat = model_manager.load_model(sim_mat_name)
             print('Movie similarity model has saved before.\nLoad model success...\n')
         except OSError:
             print('No model saved before.\nTrain a new model...')
-            self.movie_sim_mat, self.movie_popular, self.movie_count = \
-                similarity.calculate_item_similarity(trainset=trainset,
-                                                     use_iuf_similarity=self.use_iuf_similarity)
-            self.trainset = trainset
+            self.movie_sim_mat, self.movie_popular, self.movie_count = self.calculate_similarity()
+            self.fit_neighbors(model_manager)
             print('Train a new model success.')
             if self.save_model:
-                model_manager.save_model(self.movie_sim_mat,
-                                         'movie_sim_mat-iif' if self.use_iuf_similarity else 'movie_sim_mat')
+                if self.keep_similarity_matrix:
+                    model_manager.save_model(self.movie_sim_mat, sim_mat_name)
                 model_manager.save_model(self.movie_popular, 'movie_popular')
                 model_manager.save_model(self.movie_count, 'movie_count')
-                model_manager.save_model(self.trainset, 'trainset')
                 print('The new model has saved success.\n')
+        if not self.keep_similarity_matrix:
+            # the full matrix is much larger than the top-K index.
+            self.movie_sim_mat = None
+
+    def cache_params(self):
+        """
+        Hyper-parameters the saved similarity matrix depends on.
+        K is not one of them, the top-K index is saved with K in its name.
+        """
+        return {'model': 'ItemCF', 'use_iuf_similarity': self.use_iuf_similarity}
+
+    def neighbors_name(self):
+        return '%s-k=%d' % ('movie_neighbors-iif' if self.use_iuf_similarity else 'movie_neighbors', self.k_sim_movie)
+
+    def fit_neighbors(self, model_manager):
+        """
+        Build the top-K neighbour index from movie similarity matrix,
+        so recommend only touches K similar movies of each watched movie.
+        :param model_manager: model manager to save the index.
+        :return: None
+        """
+        print('build top-%d similar movies index...' % self.k_sim_movie)
+        self.movie_neighbors = TopKNeighbors.from_similarity(self.movie_sim_mat, self.k_sim_movie)
+        print('build top-%d similar movies index success.' % self.k_sim_movie)
+        if self.save_model:
+            model_manager.save_model(self.movie_neighbors, self.neighbors_name())
+
+    def calculate_similarity(self):
+        """
+        :return: movie similarity matrix, movie popularity and movie count of trainset.
+        """
+        calculate_item_similarity = similarity.calculate_item_similarity_sparse if self.use_sparse_engine \
+            else similarity.calculate_item_similarity
+        return calculate_item_similarity(trainset=self.trainset, use_iuf_similarity=self.use_iuf_similarity)
+
+    def partial_fit(self, events):
+        """
+        Update the fitted model with new ratings instead of calculating the similarity from scratch.
+        Co-occurrence counts and popularity are updated only for the pairs of movies of users in events,
+        the similarity of those pairs is renormalized,
+        and the top-K neighbours of a movie are refreshed only if a changed value can change them.
+        The updated model is not saved, its cache key belongs to the original trainset.
+        New ratings go to a copy of the trainset, the trainset passed to fit is never changed.
+        :param events: iterable of (user, movie, rating)
+        :return: set of movies whose top-K neighbours were refreshed.
+        """
+        if not self.movie_neighbors or not self.trainset:
+            raise NotImplementedError('ItemCF has not init or fit method has not called yet.')
+        if not self.owns_trainset:
+            self.trainset = utils.copy_trainset(self.trainset)
+            self.owns_trainset = True
+        if self.movie_cooccurrence is None:
+            print('recover movie co-occurrence counts...')
+            if self.movie_sim_mat is None:
+                self.movie_sim_mat = self.calculate_similarity()[0]
+            self.movie_cooccurrence = similarity.cooccurrence_from_similarity(
+                self.movie_sim_mat, self.movie_popular, self.use_iuf_similarity)
+            # updates need mutable dicts.
+            self.movie_sim_mat = {movie: dict(self.movie_sim_mat[movie].items()) for movie in self.movie_sim_mat}
+            print('recover movie co-occurrence counts success.')
+        changed_pairs, popular_movies = similarity.update_item_cooccurrence(
+            self.movie_cooccurrence, self.movie_popular, self.trainset, events, self.use_iuf_similarity)
+        self.movie_count = len(self.movie_popular)
+        return similarity.refresh_similarity(self.movie_sim_mat, self.movie_cooccurrence, self.movie_popular,
+                                             self.movie_neighbors, changed_pairs, popular_movies, self.k_sim_movie)
 
     def recommend(self, user):
         """
@@ -74,10 +157,9 @@ class ItemBasedCF:
         :param user: The user we recommend movies to.
         :return: the N best score movies
         """
-        if not self.movie_sim_mat or not self.n_rec_movie or \
+        if not self.movie_neighbors or not self.n_rec_movie or \
                 not self.trainset or not self.movie_popular or not self.movie_count:
             raise NotImplementedError('ItemCF has not init or fit method has not called yet.')
-        K = self.k_sim_movie
         N = self.n_rec_movie
         predict_score = collections.defaultdict(int)
         if user not in self.trainset:
@@ -86,8 +168,7 @@ class ItemBasedCF:
         # print('Recommend movies to user start...')
         watched_movies = self.trainset[user]
         for movie, rating in watched_movies.items():
-            for related_movie, similarity_factor in sorted(self.movie_sim_mat[movie].items(),
-                                                           key=itemgetter(1), reverse=True)[0:K]:
+            for related_movie, similarity_factor in self.movie_neighbors.neighbors(movie):
                 if related_movie in watched_movies:
                     continue
                 # predict the user's "interest" for each movie
@@ -96,53 +177,78 @@ class ItemBasedCF:
                 # log steps and times.
         # print('Recommend movies to user success.')
         # return the N best score movies
-        return [movie for movie, _ in sorted(predict_score.items(), key=itemgetter(1), reverse=True)[0:N]]
+        return [movie for movie, _ in utils.top_n_items(predict_score, N)]
+
+    def recommend_batch(self, users, n=None):
+        """
+        Recommend N movies for each user in one call.
+        This is the product of each user's rating row and the top-K neighbour matrix,
+        accumulated in a dense score array indexed by movie instead of a dict.
+        Results are the same as recommend(user).
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user, best first.
+                 Users not in trainset get empty lists.
+        """
+        if not self.movie_neighbors or not self.n_rec_movie or \
+                not self.trainset or not self.movie_popular or not self.movie_count:
+            raise NotImplementedError('ItemCF has not init or fit method has not called yet.')
+        N = n or self.n_rec_movie
+        index, K = self.movie_neighbors.index, self.movie_neighbors.k
+        ids, sim_scores = self.movie_neighbors.ids, self.movie_neighbors.scores
+        raw_ids, inner_ids = index.raw_ids, index.inner_ids
+        acc = [0.0] * len(index)
+        # 1 for watched movies, 2 for movies with a score of the current user.
+        mask = bytearray(len(index))
+        rec_movies, rec_scores = [], []
+        for user in users:
+            if user not in self.trainset:
+                rec_movies.append([])
+                rec_scores.append([])
+                continue
+            rated = [(inner_ids.get(movie), rating) for movie, rating in self.trainset[user].items()]
+            for i, _ in rated:
+                if i is not None:
+                    mask[i] = 1
+            touched = []
+            for i, rating in rated:
+                if i is None:
+                    continue
+                for j, similarity_factor in zip(ids[i * K:(i + 1) * K], sim_scores[i * K:(i + 1) * K]):
+                    if j < 0 or mask[j] == 1:
+                        continue
+                    if not mask[j]:
+                        mask[j] = 2
+                        touched.append(j)
+                    acc[j] += similarity_factor * rating
+            top = heapq.nsmallest(N, touched, key=lambda j: (-acc[j], raw_ids[j]))
+            rec_movies.append([raw_ids[j] for j in top])
+            rec_scores.append([acc[j] for j in top])
+            for j in touched:
+                acc[j] = 0.0
+                mask[j] = 0
+            for i, _ in rated:
+                if i is not None:
+                    mask[i] = 0
+        return rec_movies, rec_scores
 
-    def test(self, testset):
+    def test(self, testset, n_jobs=1):
         """
         Test the recommendation system by recommending scores to all users in testset.
         :param testset: test dataset
-        :return:
+        :param n_jobs: number of processes to evaluate users in parallel.
+        :return: EvaluationResult
         """
         if not self.n_rec_movie or not self.trainset or not self.movie_popular or not self.movie_count:
             raise ValueError('ItemCF has not init or fit method has not called yet.')
         self.testset = testset
         print('Test recommendation system start...')
-        N = self.n_rec_movie
-        #  varables for precision and recall
-        hit = 0
-        rec_count = 0
-        test_count = 0
-        # varables for coverage
-        all_rec_movies = set()
-        # varables for popularity
-        popular_sum = 0
-
-        # record the calculate time has spent.
-        test_time = LogTime(print_step=1000)
-        for i, user in enumerate(self.trainset):
-            test_movies = self.testset.get(user, {})
-            rec_movies = self.recommend(user)  # type:list
-            for movie in rec_movies:
-                if movie in test_movies:
-                    hit += 1
-                all_rec_movies.add(movie)
-                popular_sum += math.log(1 + self.movie_popular[movie])
-                # log steps and times.
-            rec_count += N
-            test_count += len(test_movies)
-            # print time per 500 times.
-            test_time.count_time()
-        precision = hit / (1.0 * rec_count)
-        recall = hit / (1.0 * test_count)
-        coverage = len(all_rec_movies) / (1.0 * self.movie_count)
-        popularity = popular_sum / (1.0 * rec_count)
-
-        print('Test recommendation system success.')
-        test_time.finish()
+        evaluator = evaluation.Evaluator(self.testset, self.movie_popular, self.movie_count)
+        result = evaluator.evaluate(self, self.trainset, n_jobs=n_jobs)
 
-        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\n' %
-              (precision, recall, coverage, popularity))
+        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\tndcg=%.4f\tmap=%.4f\n' %
+              (result.precision, result.recall, result.coverage, result.popularity, result.ndcg, result.map))
+        return result
 
     def predict(self, testset):
         """
@@ -152,13 +258,10 @@ class ItemBasedCF:
         """
         movies_recommend = defaultdict(list)
         print('Predict scores start...')
-        # record the calculate time has spent.
-        predict_time = LogTime(print_step=500)
-        for i, user in enumerate(testset):
-            rec_movies = self.recommend(user)  # type:list
-            movies_recommend[user].append(rec_movies)
-            # log steps and times.
-            predict_time.count_time()
+        users = list(testset)
+        with instrument.span('predict'):
+            for user, rec_movies in zip(users, self.recommend_batch(users)[0]):
+                movies_recommend[user].append(rec_movies)
+        instrument.count('predict.users', len(users))
         print('Predict scores success.')
-        predict_time.finish()
         return movies_recommend
@@ -11,14 +11,53 @@ Description : Latent Factor Model
 """
 import collections
 import random
-from operator import itemgetter
+from array import array
+from operator import mul
 
 import math
 
 from collections import defaultdict
 
+import time
+
+import evaluation
+import instrument
 import utils
-from utils import LogTime
+from sampling import NegativeSampler
+from sparse_matrix import IdIndex
+
+
+def least_squares(rows, targets, lamb, K):
+    """
+    Solve min sum((target - row * w) ^ 2) + lamb * len(rows) * |w| ^ 2,
+    the objective SGD minimizes for one latent vector when the other side is fixed,
+    by the normal equations (X^T X + lamb * n * I) w = X^T t.
+    :param rows: fixed latent vectors of the samples.
+    :param targets: label of each sample.
+    :param lamb: regular params
+    :param K: Latent factor dimension
+    :return: latent vector w
+    """
+    if not rows:
+        return [0.0] * K
+    A = [[0.0] * K for _ in range(K)]
+    b = [0.0] * K
+    for x, t in zip(rows, targets):
+        for a, xa in enumerate(x):
+            A[a] = [Aac + xa * xc for Aac, xc in zip(A[a], x)]
+            b[a] += t * xa
+    for a in range(K):
+        A[a][a] += lamb * len(rows)
+    # Gaussian elimination, A is symmetric positive definite so no pivoting is needed.
+    for c in range(K):
+        for r in range(c + 1, K):
+            f = A[r][c] / A[c][c]
+            A[r] = [Arx - f * Acx for Arx, Acx in zip(A[r], A[c])]
+            b[r] -= f * b[c]
+    w = [0.0] * K
+    for r in reversed(range(K)):
+        w[r] = (b[r] - sum(A[r][c] * w[c] for c in range(r + 1, K))) / A[r][r]
+    return w
 
 
 class LFM:
@@ -47,8 +86,12 @@ class LFM:
         self.items_list = list()
         self.P, self.Q = None, None
         self.trainset = None
+        # trainset is the object passed to fit until fold-in copies it.
+        self.owns_trainset = False
         self.testset = None
         self.item_popular, self.items_count = None, None
+        # random generator of negative samples.
+        self.rng = random
         self.model_name = 'K={}-epochs={}-alpha={}-lamb={}'.format(self.K, self.epochs, self.alpha, self.lamb)
 
     def init_model(self, users_set, items_set, K):
@@ -117,21 +160,25 @@ class LFM:
             rate_e += Puk * Qki
         return rate_e
 
-    def train(self, trainset):
+    def train(self, trainset, epochs=None):
         """
         Train model.
         :param trainset: Origin trainset.
+        :param epochs: epochs to go, self.epochs by default.
         :return: None
         """
-        for epoch in range(self.epochs):
+        for epoch in range(epochs or self.epochs):
             print('epoch:', epoch)
-            for user in trainset:
-                samples = self.gen_negative_sample(trainset[user])
-                for item, rui in samples.items():
-                    eui = rui - self.predict(user, item)
-                    for k in range(self.K):
-                        self.P[user][k] += self.alpha * (eui * self.Q[item][k] - self.lamb * self.P[user][k])
-                        self.Q[item][k] += self.alpha * (eui * self.P[user][k] - self.lamb * self.Q[item][k])
+            with instrument.span('lfm.epoch'):
+                for user in trainset:
+                    with instrument.span('lfm.negative_sampling'):
+                        samples = self.gen_negative_sample(trainset[user])
+                    instrument.count('lfm.samples', len(samples))
+                    for item, rui in samples.items():
+                        eui = rui - self.predict(user, item)
+                        for k in range(self.K):
+                            self.P[user][k] += self.alpha * (eui * self.Q[item][k] - self.lamb * self.P[user][k])
+                            self.Q[item][k] += self.alpha * (eui * self.P[user][k] - self.lamb * self.Q[item][k])
             self.alpha *= 0.9
             # print(self.P)
             # print(self.Q)
@@ -143,12 +190,12 @@ class LFM:
         :return: None
         """
         self.trainset = trainset
+        self.owns_trainset = False
         self.users_set, self.items_set, self.items_list, self.item_popular, self.items_count = \
             self.init_users_items_set(trainset)
-        model_manager = utils.ModelManager()
+        model_manager = utils.ModelManager(params=self.cache_params(), trainset=trainset)
         try:
-            self.P = model_manager.load_model(self.model_name + '-P')
-            self.Q = model_manager.load_model(self.model_name + '-Q')
+            self.load_factors(model_manager)
             print('User origin similarity model has saved before.\nLoad model success...\n')
         except OSError:
             print('No model saved before.\nTrain a new model...')
@@ -156,11 +203,163 @@ class LFM:
             self.train(self.trainset)
             print('Train a new model success.')
             if self.save_model:
-                model_manager.save_model(self.P, self.model_name + '-P')
-                model_manager.save_model(self.Q, self.model_name + '-Q')
+                self.save_factors(model_manager)
             print('The new model has saved success.\n')
         return self.P, self.Q
 
+    def cache_params(self):
+        # model_name has the initial alpha, self.alpha decays while training.
+        return {'model': type(self).__name__, 'name': self.model_name}
+
+    def load_factors(self, model_manager):
+        self.P = model_manager.load_model(self.model_name + '-P')
+        self.Q = model_manager.load_model(self.model_name + '-Q')
+
+    def save_factors(self, model_manager):
+        model_manager.save_model(self.P, self.model_name + '-P')
+        model_manager.save_model(self.Q, self.model_name + '-Q')
+
+    def has_user(self, user):
+        return user in self.P
+
+    def has_item(self, item):
+        return item in self.Q
+
+    def user_factors(self, user):
+        return self.P[user]
+
+    def item_factors(self, item):
+        return self.Q[item]
+
+    def set_user_factors(self, user, Pu):
+        self.P[user] = Pu
+
+    def set_item_factors(self, item, Qi):
+        self.Q[item] = Qi
+
+    def known_users(self):
+        return list(self.P)
+
+    def sample_negatives(self, positives, population):
+        """
+        Draw negative samples with the same ratio as training:
+        up to 11 draws per positive, and at most 9 distinct negatives per positive.
+        :param positives: set of positive samples.
+        :param population: list to draw from, items repeat by their popularity.
+        :return: list of negative samples
+        """
+        negatives = []
+        negatives_set = set()
+        for _ in range(11 * len(positives)):
+            sample = population[self.rng.randint(0, len(population) - 1)]
+            if sample in positives or sample in negatives_set:
+                continue
+            negatives.append(sample)
+            negatives_set.add(sample)
+            if len(negatives) >= 9 * len(positives):
+                break
+        return negatives
+
+    def user_vector(self, items):
+        """
+        Compute the latent vector of a user from the user's items against the fixed Q,
+        by least squares on the positive items and popularity sampled negative items.
+        :param items: items the user interacted with, items not in Q are ignored.
+        :return: latent vector
+        """
+        positives = [item for item in items if self.has_item(item)]
+        negatives = self.sample_negatives(set(positives), self.items_list)
+        return least_squares([self.item_factors(item) for item in positives + negatives],
+                             [1.0] * len(positives) + [0.0] * len(negatives), self.lamb, self.K)
+
+    def item_vector(self, users):
+        """
+        Compute the latent vector of an item from its users against the fixed P,
+        by least squares on the positive users and uniformly sampled negative users.
+        :param users: users who interacted with the item, users not in P are ignored.
+        :return: latent vector
+        """
+        positives = [user for user in users if self.has_user(user)]
+        negatives = self.sample_negatives(set(positives), self.known_users())
+        return least_squares([self.user_factors(user) for user in positives + negatives],
+                             [1.0] * len(positives) + [0.0] * len(negatives), self.lamb, self.K)
+
+    def mutable_trainset(self):
+        """
+        :return: trainset owned by the model, copied from the trainset passed to fit or warm_start
+                 the first time, so fold-in never changes the caller's trainset.
+        """
+        if not self.owns_trainset:
+            self.trainset = utils.copy_trainset(self.trainset)
+            self.owns_trainset = True
+        return self.trainset
+
+    @instrument.timed('lfm.fold_in_user')
+    def fold_in_user(self, user, items: dict):
+        """
+        Fold a new user into the fitted model without training, see user_vector.
+        The items are added to trainset, so they are not recommended to the user.
+        :param user: new user, or an existing user to recompute.
+        :param items: dict of {item: rating} the user interacted with.
+        :return: latent vector of the user
+        """
+        Pu = self.user_vector(items)
+        self.set_user_factors(user, Pu)
+        self.mutable_trainset().setdefault(user, {}).update(items)
+        self.users_set.add(user)
+        return Pu
+
+    @instrument.timed('lfm.fold_in_item')
+    def fold_in_item(self, item, users: dict):
+        """
+        Fold a new item into the fitted model without training, see item_vector.
+        The users who interacted with the item are added to trainset.
+        :param item: new item, or an existing item to recompute.
+        :param users: dict of {user: rating} of users who interacted with the item.
+        :return: latent vector of the item
+        """
+        Qi = self.item_vector(users)
+        self.set_item_factors(item, Qi)
+        trainset = self.mutable_trainset()
+        for user, rating in users.items():
+            if item not in trainset.setdefault(user, {}):
+                self.item_popular[item] += 1
+                self.items_list.append(item)
+            trainset[user][item] = rating
+        self.items_set.add(item)
+        self.items_count = len(self.items_set)
+        return Qi
+
+    def warm_start(self, trainset, epochs=1):
+        """
+        Resume training from the current P and Q on a trainset with new ratings,
+        e.g. after fit loaded the P and Q saved for the old trainset.
+        New items and then new users are folded in first, so a few epochs are enough.
+        The model is not saved, its cache key belongs to the old trainset.
+        :param trainset: train dataset with new ratings.
+        :param epochs: epochs to go.
+        :return: P, Q
+        """
+        if self.P is None or self.Q is None:
+            raise NotImplementedError('LFM has not init or fit method has not called yet.')
+        self.trainset = trainset
+        self.owns_trainset = False
+        self.users_set, self.items_set, self.items_list, self.item_popular, self.items_count = \
+            self.init_users_items_set(trainset)
+        new_items = collections.OrderedDict()
+        for user, items in trainset.items():
+            for item in items:
+                if not self.has_item(item):
+                    new_items.setdefault(item, []).append(user)
+        for item, users in new_items.items():
+            self.set_item_factors(item, self.item_vector(users))
+        new_users = [user for user in trainset if not self.has_user(user)]
+        for user in new_users:
+            self.set_user_factors(user, self.user_vector(trainset[user]))
+        print('fold in %d new items and %d new users, warm start training...' % (len(new_items), len(new_users)))
+        self.train(trainset, epochs)
+        return self.P, self.Q
+
     def recommend(self, user):
         """
         Recommend N movies for the user.
@@ -174,45 +373,267 @@ class LFM:
                 continue
             for k, Qik in enumerate(self.Q[item]):
                 rank[item] += self.P[user][k] * Qik
-        return [movie for movie, _ in sorted(rank.items(), key=itemgetter(1), reverse=True)][:self.n_rec_movie]
+        return [movie for movie, _ in utils.top_n_items(rank, self.n_rec_movie)]
 
-    def test(self, testset):
+    def recommend_batch(self, users, n=None):
+        """
+        Recommend N movies for each user in one call.
+        Q is unpacked into one list per latent factor once,
+        then the scores of all items of a user are P[u] * Q, one pass over Q per factor.
+        Results are the same as recommend(user).
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user, best first.
+                 Users not in trainset get empty lists.
+        """
+        N = n or self.n_rec_movie
+        items = list(self.items_set)
+        Q_rows = [[self.Q[item][k] for item in items] for k in range(self.K)]
+        rec_movies, rec_scores = [], []
+        for user in users:
+            if user not in self.trainset or not self.has_user(user):
+                rec_movies.append([])
+                rec_scores.append([])
+                continue
+            scores = [0.0] * len(items)
+            for Puk, Qk in zip(self.P[user], Q_rows):
+                scores = [score + Puk * Qki for score, Qki in zip(scores, Qk)]
+            interacted_items = self.trainset[user]
+            top = utils.top_n_items({item: score for item, score in zip(items, scores)
+                                     if item not in interacted_items}, N)
+            rec_movies.append([item for item, _ in top])
+            rec_scores.append([score for _, score in top])
+        return rec_movies, rec_scores
+
+    def test(self, testset, n_jobs=1):
         """
         Test the recommendation system by recommending scores to all users in testset.
         :param testset: test dataset
-        :return: None
+        :param n_jobs: number of processes to evaluate users in parallel.
+        :return: EvaluationResult
         """
         self.testset = testset
         print('Test recommendation system start...')
-        #  varables for precision and recall
-        hit = 0
-        rec_count = 0
-        test_count = 0
-        # varables for coverage
-        all_rec_movies = set()
-        # varables for popularity
-        popular_sum = 0
-
-        # record the calculate time has spent.
-        test_time = LogTime(print_step=1000)
-        for user in self.users_set:
-            test_movies = self.testset.get(user, {})
-            rec_movies = self.recommend(user)  # type:list
-            for movie in rec_movies:
-                if movie in test_movies.keys():
-                    hit += 1
-                all_rec_movies.add(movie)
-                popular_sum += math.log(1 + self.item_popular[movie])
-                # log steps and times.
-            rec_count += self.n_rec_movie
-            test_count += len(test_movies)
-            # print time per 500 times.
-            test_time.count_time()
-        precision = hit / (1.0 * rec_count)
-        recall = hit / (1.0 * test_count)
-        coverage = len(all_rec_movies) / (1.0 * self.items_count)
-        popularity = popular_sum / (1.0 * rec_count)
-        print('Test recommendation system success.')
-        test_time.finish()
-        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\n' %
-              (precision, recall, coverage, popularity))
+        evaluator = evaluation.Evaluator(self.testset, self.item_popular, self.items_count)
+        result = evaluator.evaluate(self, self.users_set, n_jobs=n_jobs)
+        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\tndcg=%.4f\tmap=%.4f\n' %
+              (result.precision, result.recall, result.coverage, result.popularity, result.ndcg, result.map))
+        return result
+
+
+class ArrayLFM(LFM):
+    """
+    Latent Factor Model with P and Q kept as contiguous float32 arrays.
+    Users and items are mapped to inner indices.
+    P is user-major: P[u * K + k]. Q is factor-major: Q[k * n_items + i],
+    so a user is scored against the whole catalog with K passes over Q.
+    Top-N recommendation.
+    """
+
+    def __init__(self, K, epochs, alpha, lamb, n_rec_movie=10, save_model=True, seed=None):
+        """
+        Init ArrayLFM with the same params as LFM.
+        :param seed: seed of init, negative sampling and shuffling.
+                     None uses the global random module, which is seeded in dataset.
+        """
+        super().__init__(K, epochs, alpha, lamb, n_rec_movie=n_rec_movie, save_model=save_model)
+        self.seed = seed
+        self.rng = random if seed is None else random.Random(seed)
+        self.negative_sampler = None
+        self.user_index, self.item_index = None, None
+        self.model_name = 'array-' + self.model_name
+
+    def init_model(self, users_set, items_set, K):
+        """
+        Init model, set P and Q with random numbers.
+        :param users_set: Users set
+        :param items_set: Items set
+        :param K: Latent factor dimension.
+        :return: None
+        """
+        self.user_index = IdIndex(sorted(users_set))
+        self.item_index = IdIndex(sorted(items_set))
+        self.P = array('f', [self.rng.random() / math.sqrt(K) for _ in range(len(self.user_index) * K)])
+        self.Q = array('f', [self.rng.random() / math.sqrt(K) for _ in range(len(self.item_index) * K)])
+
+    def predict(self, user, item):
+        """
+        Predict the rate for item given user and P and Q.
+        :param user: Given a user
+        :param item: Given a item to predict the rate
+        :return: The predict rate
+        """
+        u, i = self.user_index.to_inner(user), self.item_index.to_inner(item)
+        n_items = len(self.item_index)
+        return sum(self.P[u * self.K + k] * self.Q[k * n_items + i] for k in range(self.K))
+
+    def train(self, trainset, epochs=None):
+        """
+        Train model, and report loss and throughput of each epoch.
+        SGD updates single numbers, which is faster on rows of Python floats,
+        so P and Q are unpacked to rows while training.
+        :param trainset: Origin trainset.
+        :param epochs: epochs to go, self.epochs by default.
+        :return: None
+        """
+        K, n_items = self.K, len(self.item_index)
+        P = [self.P[u * K:(u + 1) * K].tolist() for u in range(len(self.user_index))]
+        Q = [list(row) for row in zip(*[self.Q[k * n_items:(k + 1) * n_items] for k in range(K)])]
+        for epoch in range(epochs or self.epochs):
+            start = time.perf_counter()
+            with instrument.span('lfm.epoch'):
+                with instrument.span('lfm.negative_sampling'):
+                    samples = self.gen_epoch_samples(trainset)
+                with instrument.span('lfm.sgd'):
+                    loss = self.train_sgd_epoch(samples, P, Q)
+            instrument.count('lfm.samples', len(samples))
+            print('epoch: %d\tloss=%.4f\t%.0f samples/s' %
+                  (epoch, loss / len(samples), len(samples) / (time.perf_counter() - start)))
+            self.alpha *= 0.9
+        self.P = array('f', [Puk for Pu in P for Puk in Pu])
+        self.Q = array('f', [Qi[k] for k in range(K) for Qi in Q])
+
+    def gen_epoch_samples(self, trainset):
+        """
+        Generate positive and negative samples of all users for an epoch.
+        :param trainset: Origin trainset.
+        :return: list of (user index, item index, label)
+        """
+        if self.negative_sampler is None:
+            positives = [array('i', [])] * len(self.user_index)
+            for user, items in trainset.items():
+                positives[self.user_index.to_inner(user)] = \
+                    array('i', [self.item_index.to_inner(item) for item in items])
+            item_popular = [self.item_popular[item] for item in self.item_index]
+            self.negative_sampler = NegativeSampler(positives, item_popular, self.rng)
+        return self.negative_sampler.sample_epoch()
+
+    def train_sgd_epoch(self, samples, P, Q):
+        """
+        Update P and Q sample by sample.
+        :return: sum of squared errors.
+        """
+        loss = 0.0
+        for u, i, rui in samples:
+            Pu, Qi = P[u], Q[i]
+            eui = rui - sum(map(mul, Pu, Qi))
+            loss += eui * eui
+            for k in range(self.K):
+                Pu[k] += self.alpha * (eui * Qi[k] - self.lamb * Pu[k])
+                Qi[k] += self.alpha * (eui * Pu[k] - self.lamb * Qi[k])
+        return loss
+
+    def cache_params(self):
+        params = super().cache_params()
+        params['seed'] = self.seed
+        return params
+
+    def load_factors(self, model_manager):
+        self.user_index = model_manager.load_model(self.model_name + '-users')
+        self.item_index = model_manager.load_model(self.model_name + '-items')
+        super().load_factors(model_manager)
+
+    def save_factors(self, model_manager):
+        model_manager.save_model(self.user_index, self.model_name + '-users')
+        model_manager.save_model(self.item_index, self.model_name + '-items')
+        super().save_factors(model_manager)
+
+    def writable_factors(self):
+        # memory-mapped P and Q are read-only.
+        if not isinstance(self.P, array):
+            self.P = array('f', self.P)
+        if not isinstance(self.Q, array):
+            self.Q = array('f', self.Q)
+
+    def has_user(self, user):
+        return user in self.user_index
+
+    def has_item(self, item):
+        return item in self.item_index
+
+    def user_factors(self, user):
+        u = self.user_index.to_inner(user)
+        return self.P[u * self.K:(u + 1) * self.K].tolist()
+
+    def item_factors(self, item):
+        i, n_items = self.item_index.to_inner(item), len(self.item_index)
+        return [self.Q[k * n_items + i] for k in range(self.K)]
+
+    def set_user_factors(self, user, Pu):
+        self.writable_factors()
+        if user in self.user_index:
+            u = self.user_index.to_inner(user)
+            self.P[u * self.K:(u + 1) * self.K] = array('f', Pu)
+        else:
+            self.user_index.add(user)
+            self.P.extend(array('f', Pu))
+            self.negative_sampler = None
+
+    def set_item_factors(self, item, Qi):
+        self.writable_factors()
+        n_items = len(self.item_index)
+        if item in self.item_index:
+            i = self.item_index.to_inner(item)
+            for k in range(self.K):
+                self.Q[k * n_items + i] = Qi[k]
+        else:
+            # a new item is a new column of every factor row of Q.
+            self.item_index.add(item)
+            Q = array('f')
+            for k in range(self.K):
+                Q.extend(self.Q[k * n_items:(k + 1) * n_items])
+                Q.append(Qi[k])
+            self.Q = Q
+            self.negative_sampler = None
+
+    def known_users(self):
+        return self.user_index.raw_ids
+
+    def warm_start(self, trainset, epochs=1):
+        # positives of existing users can change too.
+        self.negative_sampler = None
+        return super().warm_start(trainset, epochs)
+
+    def recommend(self, user):
+        """
+        Recommend N movies for the user.
+        :param user: The user we recommend movies to.
+        :return: the N best score movies
+        """
+        K, n_items = self.K, len(self.item_index)
+        u = self.user_index.to_inner(user)
+        scores = [0.0] * n_items
+        # scores = Q^T * P[u], one pass over Q for each latent factor.
+        for k, Puk in enumerate(self.P[u * K:(u + 1) * K]):
+            scores = [score + Puk * Qki for score, Qki in zip(scores, self.Q[k * n_items:(k + 1) * n_items])]
+        watched = {self.item_index.to_inner(item) for item in self.trainset[user] if item in self.item_index}
+        return [self.item_index.to_raw(i) for i in utils.top_n_indices(scores, self.n_rec_movie, watched)]
+
+    def recommend_batch(self, users, n=None):
+        """
+        Recommend N movies for each user in one call.
+        The factor rows of Q are copied out of the array once for all users.
+        Results are the same as recommend(user).
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user, best first.
+                 Users not in trainset get empty lists.
+        """
+        N = n or self.n_rec_movie
+        K, n_items = self.K, len(self.item_index)
+        Q_rows = [self.Q[k * n_items:(k + 1) * n_items].tolist() for k in range(K)]
+        rec_movies, rec_scores = [], []
+        for user in users:
+            if user not in self.trainset or not self.has_user(user):
+                rec_movies.append([])
+                rec_scores.append([])
+                continue
+            u = self.user_index.to_inner(user)
+            scores = [0.0] * n_items
+            for Puk, Qk in zip(self.P[u * K:(u + 1) * K], Q_rows):
+                scores = [score + Puk * Qki for score, Qki in zip(scores, Qk)]
+            watched = {self.item_index.to_inner(item) for item in self.trainset[user] if item in self.item_index}
+            top = utils.top_n_indices(scores, N, watched)
+            rec_movies.append([self.item_index.to_raw(i) for i in top])
+            rec_scores.append([scores[i] for i in top])
+        return rec_movies, rec_scores
@@ -7,15 +7,15 @@ Created on 2018-04-15
 @author: fuxuemingzhu
 """
 import collections
-from operator import itemgetter
-
-import math
+import heapq
 
 from collections import defaultdict
 
+import evaluation
+import instrument
 import similarity
 import utils
-from utils import LogTime
+from sparse_matrix import TopKNeighbors
 
 
 class UserBasedCF:
@@ -24,9 +24,15 @@ class UserBasedCF:
     Top-N recommendation.
     """
 
-    def __init__(self, k_sim_user=20, n_rec_movie=10, use_iif_similarity=False, save_model=True):
+    def __init__(self, k_sim_user=20, n_rec_movie=10, use_iif_similarity=False, save_model=True,
+                 use_sparse_engine=True, keep_similarity_matrix=True, rebuild_every=None):
         """
         Init UserBasedCF with n_sim_user and n_rec_movie.
+        :param use_sparse_engine: calculate similarity with sparse matrices instead of dicts.
+        :param keep_similarity_matrix: keep and save the full user similarity matrix.
+                                       recommend only needs the top-K similar users index.
+        :param rebuild_every: partial_fit rebuilds the whole similarity matrix
+                              once this many events have been applied incrementally, None for never.
         :return: None
         """
         print("UserBasedCF start...\n")
@@ -35,6 +41,16 @@ class UserBasedCF:
         self.trainset = None
         self.save_model = save_model
         self.use_iif_similarity = use_iif_similarity
+        self.use_sparse_engine = use_sparse_engine
+        self.keep_similarity_matrix = keep_similarity_matrix
+        self.user_sim_mat = None
+        self.user_neighbors = None
+        # (users index, movies index, CSR rating matrix) of trainset, built by recommend_batch.
+        self.rating_matrix = None
+        self.rebuild_every = rebuild_every
+        # trainset is the object passed to fit until partial_fit copies it.
+        self.owns_trainset = False
+        self.reset_incremental_state()
 
     def fit(self, trainset):
         """
@@ -42,27 +58,139 @@ class UserBasedCF:
         :param trainset: train dataset
         :return: None
         """
-        model_manager = utils.ModelManager()
+        model_manager = utils.ModelManager(params=self.cache_params(), trainset=trainset)
+        sim_mat_name = 'user_sim_mat-iif' if self.use_iif_similarity else 'user_sim_mat'
+        self.trainset = trainset
+        self.owns_trainset = False
+        self.rating_matrix = None
+        self.reset_incremental_state()
         try:
-            self.user_sim_mat = model_manager.load_model(
-                'user_sim_mat-iif' if self.use_iif_similarity else 'user_sim_mat')
             self.movie_popular = model_manager.load_model('movie_popular')
             self.movie_count = model_manager.load_model('movie_count')
-            self.trainset = model_manager.load_model('trainset')
+            try:
+                self.user_neighbors = model_manager.load_model(self.neighbors_name())
+            except OSError:
+                self.user_sim_mat = model_manager.load_model(sim_mat_name)
+                self.fit_neighbors(model_manager)
+            if self.keep_similarity_matrix and self.user_sim_mat is None:
+                self.user_sim_mat = model_manager.load_model(sim_mat_name)
             print('User origin similarity model has saved before.\nLoad model success...\n')
         except OSError:
             print('No model saved before.\nTrain a new model...')
-            self.user_sim_mat, self.movie_popular, self.movie_count = \
-                similarity.calculate_user_similarity(trainset=trainset,
-                                                     use_iif_similarity=self.use_iif_similarity)
-            self.trainset = trainset
+            self.user_sim_mat, self.movie_popular, self.movie_count = self.calculate_similarity()
+            self.fit_neighbors(model_manager)
             print('Train a new model success.')
             if self.save_model:
-                model_manager.save_model(self.user_sim_mat,
-                                         'user_sim_mat-iif' if self.use_iif_similarity else 'user_sim_mat')
+                if self.keep_similarity_matrix:
+                    model_manager.save_model(self.user_sim_mat, sim_mat_name)
                 model_manager.save_model(self.movie_popular, 'movie_popular')
                 model_manager.save_model(self.movie_count, 'movie_count')
             print('The new model has saved success.\n')
+        if not self.keep_similarity_matrix:
+            # the full matrix is much larger than the top-K index.
+            self.user_sim_mat = None
+
+    def reset_incremental_state(self):
+        # co-rated counts of users, the movie-users inverse table and the number of movies of each user,
+        # recovered by the first partial_fit.
+        self.user_cooccurrence = None
+        self.movie2users = None
+        self.user_popular = None
+        # number of events applied by partial_fit since the last full calculation.
+        self.partial_events = 0
+
+    def cache_params(self):
+        """
+        Hyper-parameters the saved similarity matrix depends on.
+        K is not one of them, the top-K index is saved with K in its name.
+        """
+        return {'model': 'UserCF', 'use_iif_similarity': self.use_iif_similarity}
+
+    def neighbors_name(self):
+        return '%s-k=%d' % ('user_neighbors-iif' if self.use_iif_similarity else 'user_neighbors', self.k_sim_user)
+
+    def fit_neighbors(self, model_manager):
+        """
+        Build the top-K similar users index from user similarity matrix.
+        :param model_manager: model manager to save the index, None to not save it.
+        :return: None
+        """
+        print('build top-%d similar users index...' % self.k_sim_user)
+        self.user_neighbors = TopKNeighbors.from_similarity(self.user_sim_mat, self.k_sim_user)
+        print('build top-%d similar users index success.' % self.k_sim_user)
+        if self.save_model and model_manager is not None:
+            model_manager.save_model(self.user_neighbors, self.neighbors_name())
+
+    def partial_fit(self, events):
+        """
+        Update the fitted model with new ratings instead of calculating the similarity from scratch.
+        New ratings are added to the movie-users inverse table, co-rated counts are updated
+        only for the pairs of users who have seen the same new movies,
+        the similarity of those pairs and of users with new ratings is renormalized,
+        and the top-K similar users are refreshed only if a changed value can change them.
+        Every rebuild_every events the whole similarity matrix is calculated again instead.
+        The updated model is not saved, its cache key belongs to the original trainset.
+        New ratings go to a copy of the trainset, the trainset passed to fit is never changed.
+        :param events: iterable of (user, movie, rating)
+        :return: set of users whose top-K similar users were refreshed.
+        """
+        if not self.user_neighbors or not self.trainset:
+            raise NotImplementedError('UserCF has not init or fit method has not called yet.')
+        events = list(events)
+        if not self.owns_trainset:
+            self.trainset = utils.copy_trainset(self.trainset)
+            self.owns_trainset = True
+        if self.rebuild_every is not None and self.partial_events + len(events) >= self.rebuild_every:
+            return self.rebuild(events)
+        if self.user_cooccurrence is None:
+            print('recover user co-rated counts...')
+            if self.user_sim_mat is None:
+                self.user_sim_mat = self.calculate_similarity()[0]
+            self.user_popular = {user: len(movies) for user, movies in self.trainset.items()}
+            self.user_cooccurrence = similarity.cooccurrence_from_similarity(
+                self.user_sim_mat, self.user_popular, self.use_iif_similarity)
+            self.user_sim_mat = {user: dict(self.user_sim_mat[user].items()) for user in self.user_sim_mat}
+            self.movie2users = defaultdict(set)
+            for user, movies in self.trainset.items():
+                for movie in movies:
+                    self.movie2users[movie].add(user)
+            print('recover user co-rated counts success.')
+        changed_pairs, changed_users = similarity.update_user_cooccurrence(
+            self.user_cooccurrence, self.movie2users, self.movie_popular, self.trainset, events,
+            self.use_iif_similarity)
+        for user in changed_users:
+            self.user_popular[user] = len(self.trainset[user])
+        self.movie_count = len(self.movie_popular)
+        self.rating_matrix = None
+        self.partial_events += len(events)
+        return similarity.refresh_similarity(self.user_sim_mat, self.user_cooccurrence, self.user_popular,
+                                             self.user_neighbors, changed_pairs, changed_users, self.k_sim_user)
+
+    def rebuild(self, events=()):
+        """
+        Add new ratings to trainset, then calculate the similarity matrix and top-K similar users from scratch.
+        :param events: iterable of (user, movie, rating)
+        :return: set of all users.
+        """
+        print('rebuild user similarity matrix...')
+        for user, movie, rating in events:
+            self.trainset.setdefault(user, {})[movie] = rating
+        self.user_sim_mat, self.movie_popular, self.movie_count = self.calculate_similarity()
+        self.fit_neighbors(None)
+        self.rating_matrix = None
+        self.reset_incremental_state()
+        if not self.keep_similarity_matrix:
+            self.user_sim_mat = None
+        print('rebuild user similarity matrix success.')
+        return set(self.user_neighbors.index)
+
+    def calculate_similarity(self):
+        """
+        :return: user similarity matrix, movie popularity and movie count of trainset.
+        """
+        calculate_user_similarity = similarity.calculate_user_similarity_sparse if self.use_sparse_engine \
+            else similarity.calculate_user_similarity
+        return calculate_user_similarity(trainset=self.trainset, use_iif_similarity=self.use_iif_similarity)
 
     def recommend(self, user):
         """
@@ -70,10 +198,9 @@ class UserBasedCF:
         :param user: The user we recommend movies to.
         :return: the N best score movies
         """
-        if not self.user_sim_mat or not self.n_rec_movie or \
+        if not self.user_neighbors or not self.n_rec_movie or \
                 not self.trainset or not self.movie_popular or not self.movie_count:
             raise NotImplementedError('UserCF has not init or fit method has not called yet.')
-        K = self.k_sim_user
         N = self.n_rec_movie
         predict_score = collections.defaultdict(int)
         if user not in self.trainset:
@@ -81,8 +208,7 @@ class UserBasedCF:
             return
         # print('Recommend movies to user start...')
         watched_movies = self.trainset[user]
-        for similar_user, similarity_factor in sorted(self.user_sim_mat[user].items(),
-                                                      key=itemgetter(1), reverse=True)[0:K]:
+        for similar_user, similarity_factor in self.user_neighbors.neighbors(user):
             for movie, rating in self.trainset[similar_user].items():
                 if movie in watched_movies:
                     continue
@@ -92,53 +218,84 @@ class UserBasedCF:
                 # log steps and times.
         # print('Recommend movies to user success.')
         # return the N best score movies
-        return [movie for movie, _ in sorted(predict_score.items(), key=itemgetter(1), reverse=True)[0:N]]
+        return [movie for movie, _ in utils.top_n_items(predict_score, N)]
+
+    def recommend_batch(self, users, n=None):
+        """
+        Recommend N movies for each user in one call.
+        This is the product of each user's top-K similarity row and the user-movie rating matrix,
+        accumulated in a dense score array indexed by movie instead of a dict.
+        Results are the same as recommend(user).
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user, best first.
+                 Users not in trainset get empty lists.
+        """
+        if not self.user_neighbors or not self.n_rec_movie or \
+                not self.trainset or not self.movie_popular or not self.movie_count:
+            raise NotImplementedError('UserCF has not init or fit method has not called yet.')
+        N = n or self.n_rec_movie
+        if self.rating_matrix is None:
+            self.rating_matrix = similarity.build_rating_matrix(self.trainset)
+        user_index, movie_index, matrix = self.rating_matrix
+        indptr, indices, ratings = matrix.indptr, matrix.indices, matrix.data
+        raw_movies = movie_index.raw_ids
+        K, neighbor_ids, sim_scores = self.user_neighbors.k, self.user_neighbors.ids, self.user_neighbors.scores
+        # rating matrix row of each user in the neighbours index.
+        rows = [user_index.to_inner(user) for user in self.user_neighbors.index]
+        acc = [0.0] * len(movie_index)
+        # 1 for watched movies, 2 for movies with a score of the current user.
+        mask = bytearray(len(movie_index))
+        rec_movies, rec_scores = [], []
+        for user in users:
+            if user not in self.trainset or user not in self.user_neighbors:
+                rec_movies.append([])
+                rec_scores.append([])
+                continue
+            u = user_index.to_inner(user)
+            watched = indices[indptr[u]:indptr[u + 1]]
+            for j in watched:
+                mask[j] = 1
+            touched = []
+            start = self.user_neighbors.index.to_inner(user) * K
+            for v, similarity_factor in zip(neighbor_ids[start:start + K], sim_scores[start:start + K]):
+                if v < 0:
+                    continue
+                row = rows[v]
+                for j, rating in zip(indices[indptr[row]:indptr[row + 1]], ratings[indptr[row]:indptr[row + 1]]):
+                    if mask[j] == 1:
+                        continue
+                    if not mask[j]:
+                        mask[j] = 2
+                        touched.append(j)
+                    acc[j] += similarity_factor * rating
+            top = heapq.nsmallest(N, touched, key=lambda j: (-acc[j], raw_movies[j]))
+            rec_movies.append([raw_movies[j] for j in top])
+            rec_scores.append([acc[j] for j in top])
+            for j in touched:
+                acc[j] = 0.0
+                mask[j] = 0
+            for j in watched:
+                mask[j] = 0
+        return rec_movies, rec_scores
 
-    def test(self, testset):
+    def test(self, testset, n_jobs=1):
         """
         Test the recommendation system by recommending scores to all users in testset.
         :param testset: test dataset
-        :return:
+        :param n_jobs: number of processes to evaluate users in parallel.
+        :return: EvaluationResult
         """
         if not self.n_rec_movie or not self.trainset or not self.movie_popular or not self.movie_count:
             raise ValueError('UserCF has not init or fit method has not called yet.')
         self.testset = testset
         print('Test recommendation system start...')
-        N = self.n_rec_movie
-        #  varables for precision and recall
-        hit = 0
-        rec_count = 0
-        test_count = 0
-        # varables for coverage
-        all_rec_movies = set()
-        # varables for popularity
-        popular_sum = 0
-
-        # record the calculate time has spent.
-        test_time = LogTime(print_step=1000)
-        for i, user in enumerate(self.trainset):
-            test_movies = self.testset.get(user, {})
-            rec_movies = self.recommend(user)  # type:list
-            for movie in rec_movies:
-                if movie in test_movies:
-                    hit += 1
-                all_rec_movies.add(movie)
-                popular_sum += math.log(1 + self.movie_popular[movie])
-                # log steps and times.
-            rec_count += N
-            test_count += len(test_movies)
-            # print time per 500 times.
-            test_time.count_time()
-        precision = hit / (1.0 * rec_count)
-        recall = hit / (1.0 * test_count)
-        coverage = len(all_rec_movies) / (1.0 * self.movie_count)
-        popularity = popular_sum / (1.0 * rec_count)
-
-        print('Test recommendation system success.')
-        test_time.finish()
+        evaluator = evaluation.Evaluator(self.testset, self.movie_popular, self.movie_count)
+        result = evaluator.evaluate(self, self.trainset, n_jobs=n_jobs)
 
-        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\n' %
-              (precision, recall, coverage, popularity))
+        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\tndcg=%.4f\tmap=%.4f\n' %
+              (result.precision, result.recall, result.coverage, result.popularity, result.ndcg, result.map))
+        return result
 
     def predict(self, testset):
         """
@@ -148,13 +305,10 @@ class UserBasedCF:
         """
         movies_recommend = defaultdict(list)
         print('Predict scores start...')
-        # record the calculate time has spent.
-        predict_time = LogTime(print_step=500)
-        for i, user in enumerate(testset):
-            rec_movies = self.recommend(user)  # type:list
-            movies_recommend[user].append(rec_movies)
-            # log steps and times.
-            predict_time.count_time()
+        users = list(testset)
+        with instrument.span('predict'):
+            for user, rec_movies in zip(users, self.recommend_batch(users)[0]):
+                movies_recommend[user].append(rec_movies)
+        instrument.count('predict.users', len(users))
         print('Predict scores success.')
-        predict_time.finish()
         return movies_recommend
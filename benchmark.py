@@ -0,0 +1,257 @@
+# -*- coding = utf-8 -*-
+"""
+Benchmark fit, recommend, recommend_batch and test of every model.
+
+Every (dataset, model) case runs in a forked process, which inherits the split dataset,
+so wall times and the peak RSS of a case are not mixed up with other cases.
+Models are fitted into an empty temporary model cache and are not saved,
+so fit always measures training, never loading.
+
+Results are written as JSON and two result files can be compared,
+e.g. the results of two commits:
+
+    python benchmark.py --datasets ml-100k synthetic:5000x2000x0.01 --output bench-new.json
+    python benchmark.py --compare bench-old.json bench-new.json
+
+Datasets are built-in datasets, e.g. ml-100k or synthetic-1m,
+or synthetic:USERSxITEMSxDENSITY, which is registered as a synthetic dataset of that size,
+see :func:`dataset.register_synthetic_dataset`.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import main
+import utils
+from dataset import DataSet, register_synthetic_dataset
+from storage import ModelCache
+
+MODELS = ['UserCF', 'UserCF-IIF', 'ItemCF', 'ItemCF-IUF', 'LFM', 'MostPopular', 'Random']
+
+# metrics compared between two results, lower is better for all of them.
+COMPARED_METRICS = ['fit.seconds', 'recommend.seconds', 'recommend_batch.seconds', 'test.seconds', 'peak_rss_mb']
+
+
+def load_split(dataset_name, test_size=0.1):
+    """
+    :param dataset_name: name of a built-in dataset, or synthetic:USERSxITEMSxDENSITY
+    :return: trainset and testset, split the same way as main.fit_model.
+    """
+    if dataset_name.startswith('synthetic:'):
+        n_users, n_items, density = dataset_name.split(':', 1)[1].split('x')
+        dataset_name = 'synthetic-' + dataset_name.split(':', 1)[1]
+        register_synthetic_dataset(dataset_name, int(n_users), int(n_items), float(density))
+    columns = DataSet.load_columns(name=dataset_name)
+    return DataSet.split_columns(columns, test_size=test_size, seed=0)
+
+
+def current_rss_mb():
+    """
+    :return: resident set size of this process in MB, or None if /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_case(model_name, trainset, testset, n_single=200, n_batch=1000, batch_size=100, n_jobs=1, seed=0):
+    """
+    Fit a model and time recommend, recommend_batch and test.
+    :param model_name: model name of main.create_model.
+    :param n_single: number of recommend(user) calls.
+    :param n_batch: number of users recommended with recommend_batch.
+    :param batch_size: users of each recommend_batch call.
+    :param n_jobs: processes of test.
+    :param seed: seed of sampled users.
+    :return: dict of results.
+    """
+    n_ratings = sum(len(movies) for movies in trainset.values())
+    result = {'rss_before_fit_mb': current_rss_mb(), 'n_ratings': n_ratings}
+    model = main.create_model(model_name)
+    model.save_model = False
+    start = time.perf_counter()
+    model.fit(trainset)
+    seconds = time.perf_counter() - start
+    result['fit'] = {'seconds': seconds, 'ratings_per_second': n_ratings / seconds}
+
+    rng = random.Random(seed)
+    users = list(trainset)
+    latencies = []
+    for user in (rng.choice(users) for _ in range(n_single)):
+        start = time.perf_counter()
+        model.recommend(user)
+        latencies.append(time.perf_counter() - start)
+    seconds = sum(latencies)
+    latencies.sort()
+    result['recommend'] = {'calls': n_single, 'seconds': seconds, 'calls_per_second': n_single / seconds,
+                           'p50_ms': utils.percentile(latencies, 50) * 1000,
+                           'p99_ms': utils.percentile(latencies, 99) * 1000}
+
+    batch_users = [rng.choice(users) for _ in range(n_batch)]
+    start = time.perf_counter()
+    for i in range(0, n_batch, batch_size):
+        model.recommend_batch(batch_users[i:i + batch_size])
+    seconds = time.perf_counter() - start
+    result['recommend_batch'] = {'users': n_batch, 'batch_size': batch_size, 'seconds': seconds,
+                                 'users_per_second': n_batch / seconds}
+
+    start = time.perf_counter()
+    evaluation = model.test(testset, n_jobs=n_jobs)
+    seconds = time.perf_counter() - start
+    result['test'] = {'seconds': seconds, 'users_per_second': evaluation.n_users / seconds,
+                      'precision': evaluation.precision, 'recall': evaluation.recall,
+                      'coverage': evaluation.coverage, 'popularity': evaluation.popularity}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def _run_forked_case(connection, model_name, trainset, testset, options, verbose):
+    cache_root = tempfile.mkdtemp(prefix='benchmark-')
+    # an empty cache, so nothing saved before is loaded by fit.
+    utils.ModelManager.cache = ModelCache(cache_root)
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            connection.send(run_case(model_name, trainset, testset, **options))
+    except Exception:
+        connection.send({'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+        connection.close()
+
+
+def run_benchmark(dataset_names, model_names=MODELS, test_size=0.1, verbose=False, **options):
+    """
+    Run every model on every dataset, each case in a forked process.
+    :param dataset_names: built-in dataset names or synthetic:USERSxITEMSxDENSITY
+    :param model_names: model names of main.create_model.
+    :param test_size: test size of the split.
+    :param verbose: keep the progress output of models.
+    :param options: n_single, n_batch, batch_size, n_jobs and seed of :func:`run_case`.
+    :return: dict of environment and results of all cases.
+    """
+    context = multiprocessing.get_context('fork')
+    cases = []
+    for dataset_name in dataset_names:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            trainset, testset = load_split(dataset_name, test_size)
+        for model_name in model_names:
+            print('Benchmark %s on %s...' % (model_name, dataset_name))
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_forked_case,
+                                      args=(sender, model_name, trainset, testset, options, verbose))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'error': 'benchmark process exited with code %s' % process.exitcode}
+            process.join()
+            case = dict({'dataset': dataset_name, 'model': model_name}, **result)
+            if 'error' in case:
+                print(case['error'])
+            else:
+                print('fit %.2fs, recommend %.2fms, batch %.0f users/s, test %.2fs, peak RSS %.0fMB' %
+                      (case['fit']['seconds'], case['recommend']['p50_ms'],
+                       case['recommend_batch']['users_per_second'], case['test']['seconds'], case['peak_rss_mb']))
+            cases.append(case)
+    return {'commit': git_commit(), 'created': time.time(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'test_size': test_size,
+            'options': options, 'cases': cases}
+
+
+def _metric(case, name):
+    value = case
+    for field in name.split('.'):
+        value = value.get(field) if isinstance(value, dict) else None
+    return value
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two benchmark results case by case.
+    :param old: results of the baseline, e.g. the previous commit.
+    :param new: results to check.
+    :param threshold: relative slowdown or growth of memory reported as a regression.
+    :return: list of (dataset, model, metric, old value, new value, ratio), and the regressions among them.
+    """
+    old_cases = {(case['dataset'], case['model']): case for case in old['cases']}
+    rows, regressions = [], []
+    for case in new['cases']:
+        old_case = old_cases.get((case['dataset'], case['model']))
+        if old_case is None:
+            continue
+        for name in COMPARED_METRICS:
+            old_value, new_value = _metric(old_case, name), _metric(case, name)
+            if not old_value or new_value is None:
+                continue
+            row = (case['dataset'], case['model'], name, old_value, new_value, new_value / old_value)
+            rows.append(row)
+            if row[-1] > 1 + threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark fit, recommend and test of every model.')
+    parser.add_argument('--datasets', nargs='+', default=['ml-100k'],
+                        help='built-in datasets or synthetic:USERSxITEMSxDENSITY, e.g. synthetic:5000x2000x0.01')
+    parser.add_argument('--models', nargs='+', default=MODELS)
+    parser.add_argument('--test-size', type=float, default=0.1)
+    parser.add_argument('--single', type=int, default=200, help='number of recommend(user) calls')
+    parser.add_argument('--batch', type=int, default=1000, help='number of users of recommend_batch')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--n-jobs', type=int, default=1, help='processes of test')
+    parser.add_argument('--output', default=None, help='JSON file of results')
+    parser.add_argument('--verbose', action='store_true', help='keep the progress output of models')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON files of results')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old_results = json.load(f)
+        with open(args.compare[1]) as f:
+            new_results = json.load(f)
+        rows, regressions = compare(old_results, new_results, args.threshold)
+        for row in rows:
+            print('%-28s %-12s %-24s %12.4f %12.4f %7.2fx%s' %
+                  (row + (' REGRESSION' if row in regressions else '',)))
+        print('%d regressions over %.0f%%.' % (len(regressions), args.threshold * 100))
+        sys.exit(1 if regressions else 0)
+    results = run_benchmark(args.datasets, args.models, args.test_size, args.verbose,
+                            n_single=args.single, n_batch=args.batch, batch_size=args.batch_size,
+                            n_jobs=args.n_jobs)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Results are written to %s.' % args.output)
+    else:
+        print(json.dumps(results, indent=1))
@@ -7,14 +7,35 @@ Created on 2018-04-15
 
 @author: fuxuemingzhu
 """
+import bisect
 import collections
+import mmap
 import os
 import itertools
 import random
+import struct
+from array import array
 from collections import namedtuple
+from collections.abc import Mapping
+
+import synthetic
+from sparse_matrix import CSRMatrix, IdIndex
 
 BuiltinDataset = namedtuple('BuiltinDataset', ['url', 'path', 'sep', 'reader_params'])
 
+# Typed columns of a ratings file, one row per rating.
+# user, item and timestamp are int32, rating is float32, so half-star ratings such as 3.5 are kept.
+RatingColumns = namedtuple('RatingColumns', ['user', 'item', 'rating', 'timestamp'])
+
+# Binary cache of RatingColumns, saved next to the ratings file.
+# header: magic, rows number, size and mtime of the ratings file.
+# body: user, item, timestamp as int32 and then rating as float32, so every column is aligned.
+COLUMNS_CACHE_SUFFIX = '.columns'
+COLUMNS_CACHE_MAGIC = b'MLCOLS02'
+COLUMNS_CACHE_HEADER = struct.Struct('<8sqqq')
+# characters of the ratings file parsed at once by load_columns.
+COLUMNS_CHUNK_SIZE = 1 << 24
+
 BUILTIN_DATASETS = {
     'ml-100k':
         BuiltinDataset(
@@ -36,6 +57,66 @@ BUILTIN_DATASETS = {
         ),
 }
 
+# Synthetic datasets are generated on first use, see :mod:`synthetic`.
+# name: keyword arguments of synthetic.generate_ratings except path.
+SYNTHETIC_DATASETS = {}
+
+
+def register_synthetic_dataset(name, n_users, n_items, density, sep='::', seed=0, **params):
+    """
+    Register a synthetic dataset alongside the built-in datasets.
+    Its ratings file data/<name>/ratings.dat is generated when the dataset is first used.
+    :param name: dataset name.
+    :param n_users: number of users.
+    :param n_items: number of items.
+    :param density: ratio of rated (user, item) pairs.
+    :param sep: '::' as ml-1m or a tab as ml-100k.
+    :param seed: random seed.
+    :param params: other keyword arguments of synthetic.generate_ratings, e.g. item_exponent.
+    :return: BuiltinDataset
+    """
+    BUILTIN_DATASETS[name] = BuiltinDataset(
+        url=None,
+        path='data/%s/ratings.dat' % name,
+        sep=sep,
+        reader_params=dict(line_format='user item rating timestamp',
+                           rating_scale=(1, 5),
+                           sep=sep)
+    )
+    SYNTHETIC_DATASETS[name] = dict(params, n_users=n_users, n_items=n_items, density=density, sep=sep, seed=seed)
+    return BUILTIN_DATASETS[name]
+
+
+# shapes of ml-1m, ml-10m and the Netflix prize dataset.
+register_synthetic_dataset('synthetic-1m', n_users=6040, n_items=3706, density=0.0447)
+register_synthetic_dataset('synthetic-10m', n_users=69878, n_items=10677, density=0.0134)
+register_synthetic_dataset('synthetic-100m', n_users=480189, n_items=17770, density=0.0118)
+
+
+def random_mask(rng, n, p):
+    """
+    Draw n independent flags, each set with probability p, without a Python loop over all of them.
+    One random byte is drawn for each flag and mapped by a table with bytes.translate,
+    only the flags whose byte is on the boundary of p draw a second random number.
+    :param rng: random.Random
+    :param n: number of flags.
+    :param p: probability of a set flag.
+    :return: bytearray of 0 and 1.
+    """
+    scaled = min(max(p, 0.0), 1.0) * 256
+    below = int(scaled)
+    data = rng.randbytes(n)
+    mask = bytearray(data.translate(bytes(byte < below for byte in range(256))))
+    if below < 256:
+        edge, rest = bytes([below]), scaled - below
+        k = data.find(edge)
+        while k >= 0:
+            if rng.random() < rest:
+                mask[k] = 1
+            k = data.find(edge, k + 1)
+    return mask
+
+
 # modify the random seed will change dataset spilt.
 # if you want to use the model saved before, please don't modify this seed.
 random.seed(0)
@@ -52,13 +133,12 @@ class DataSet:
         pass
 
     @classmethod
-    def load_dataset(cls, name='ml-100k'):
-        """Load a built-in dataset.
-
-        :param name:string: The name of the built-in dataset to load.
-                Accepted values are 'ml-100k', 'ml-1m', and 'jester'.
-                Default is 'ml-100k'.
-        :return: ratings for each line.
+    def get_builtin_dataset(cls, name):
+        """
+        Get a built-in dataset and check its ratings file exists.
+        The ratings file of a synthetic dataset is generated if it does not exist.
+        :param name: The name of the built-in dataset.
+        :return: BuiltinDataset
         """
         try:
             dataset = BUILTIN_DATASETS[name]
@@ -66,16 +146,152 @@ class DataSet:
             raise ValueError('unknown dataset ' + name +
                              '. Accepted values are ' +
                              ', '.join(BUILTIN_DATASETS.keys()) + '.')
+        if name in SYNTHETIC_DATASETS:
+            synthetic.ensure_ratings(dataset.path, SYNTHETIC_DATASETS[name])
         if not os.path.isfile(dataset.path):
             raise OSError(
                 "Dataset data/" + name + " could not be found in this project.\n"
                                          "Please download it from " + dataset.url +
                 ' manually and unzip it to data/ directory.')
-        with open(dataset.path) as f:
-            ratings = [cls.parse_line(line, dataset.sep) for line in itertools.islice(f, 0, None)]
+        return dataset
+
+    @classmethod
+    def load_dataset(cls, name='ml-100k'):
+        """Load a built-in dataset.
+
+        Ratings are read from the typed columns of :meth:`load_columns`,
+        so the file is only parsed once and later loads map the binary cache.
+
+        :param name:string: The name of the built-in dataset to load.
+                Accepted values are 'ml-100k', 'ml-1m', and 'jester'.
+                Default is 'ml-100k'.
+        :return: ratings for each line, (user, movie, rate) with string ids.
+        """
+        columns = cls.load_columns(name)
+        user_ids = {user: str(user) for user in set(columns.user)}
+        movie_ids = {movie: str(movie) for movie in set(columns.item)}
+        rates = {rate: int(rate) if rate.is_integer() else rate for rate in set(columns.rating)}
+        ratings = list(zip(map(user_ids.__getitem__, columns.user), map(movie_ids.__getitem__, columns.item),
+                           map(rates.__getitem__, columns.rating)))
         print("Load " + name + " dataset success.")
         return ratings
 
+    @classmethod
+    def load_dataset_chunks(cls, name='ml-100k', chunk_size=10000):
+        """
+        Load a built-in dataset lazily in fixed-size chunks,
+        so the whole ratings list is never held in memory.
+
+        :param name: The name of the built-in dataset to load.
+        :param chunk_size: ratings number of each chunk.
+        :return: generator of lists of ratings.
+        """
+        dataset = cls.get_builtin_dataset(name)
+        with open(dataset.path) as f:
+            while True:
+                chunk = [cls.parse_line(line, dataset.sep) for line in itertools.islice(f, chunk_size)]
+                if not chunk:
+                    break
+                yield chunk
+        print("Load " + name + " dataset success.")
+
+    @classmethod
+    def load_columns(cls, name='ml-100k', use_cache=True):
+        """
+        Load a built-in dataset as typed columns.
+
+        The file is parsed in bulk, COLUMNS_CHUNK_SIZE characters at a time, straight into arrays,
+        so only one chunk of fields is held as Python strings,
+        and the columns are cached in a binary file next to the ratings file.
+        Later loads memory-map the cache, which is near-instant.
+        The cache is rebuilt when the ratings file changes.
+
+        :param name: The name of the built-in dataset to load.
+        :param use_cache: read and write the binary cache.
+        :return: RatingColumns, the timestamp is kept.
+        """
+        dataset = cls.get_builtin_dataset(name)
+        cache_path = dataset.path + COLUMNS_CACHE_SUFFIX
+        if use_cache:
+            columns = cls.read_columns_cache(cache_path, dataset.path)
+            if columns is not None:
+                print("Load " + name + " dataset from cache success.")
+                return columns
+        columns = RatingColumns(user=array('i'), item=array('i'), rating=array('f'), timestamp=array('i'))
+        with open(dataset.path) as f:
+            rest = ''
+            for block in iter(lambda: f.read(COLUMNS_CHUNK_SIZE), ''):
+                # parse whole lines only, the last partial line is parsed with the next block.
+                block = rest + block
+                end = block.rfind('\n') + 1
+                cls.parse_columns(block[:end], dataset.sep, columns, dataset.path)
+                rest = block[end:]
+            cls.parse_columns(rest, dataset.sep, columns, dataset.path)
+        if use_cache:
+            cls.write_columns_cache(columns, cache_path, dataset.path)
+        print("Load " + name + " dataset success.")
+        return columns
+
+    @classmethod
+    def parse_columns(cls, text, sep, columns: RatingColumns, path):
+        """
+        Parse whole lines of a ratings file and append them to columns.
+        :param text: lines of `user sep item sep rating sep timestamp`.
+        :param sep: the separator between fields.
+        :param columns: RatingColumns of arrays to extend.
+        :param path: path of the ratings file, for the error message.
+        :return: None
+        """
+        fields = text.replace(sep, ' ').split()
+        if len(fields) % 4:
+            raise ValueError('Ratings file %s should have 4 fields in each line.' % path)
+        columns.user.extend(map(int, fields[0::4]))
+        columns.item.extend(map(int, fields[1::4]))
+        columns.rating.extend(map(float, fields[2::4]))
+        columns.timestamp.extend(map(int, fields[3::4]))
+
+    @classmethod
+    def write_columns_cache(cls, columns: RatingColumns, cache_path, source_path):
+        """
+        Write columns to the binary cache.
+        :param columns: RatingColumns
+        :param cache_path: path of the cache file.
+        :param source_path: path of the ratings file, whose size and mtime are recorded.
+        :return: None
+        """
+        stat = os.stat(source_path)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(COLUMNS_CACHE_HEADER.pack(COLUMNS_CACHE_MAGIC, len(columns.user), stat.st_size, stat.st_mtime_ns))
+            for column in (columns.user, columns.item, columns.timestamp, columns.rating):
+                column.tofile(f)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def read_columns_cache(cls, cache_path, source_path):
+        """
+        Memory-map the binary cache.
+        :param cache_path: path of the cache file.
+        :param source_path: path of the ratings file.
+        :return: RatingColumns of read-only memoryviews, or None if there is no valid cache.
+        """
+        if not os.path.isfile(cache_path) or os.path.getsize(cache_path) < COLUMNS_CACHE_HEADER.size:
+            # a truncated cache can't be mapped, the ratings file is parsed again.
+            return None
+        stat = os.stat(source_path)
+        with open(cache_path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, size, mtime_ns = COLUMNS_CACHE_HEADER.unpack_from(buffer)
+        if magic != COLUMNS_CACHE_MAGIC or (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns) or \
+                len(buffer) != COLUMNS_CACHE_HEADER.size + 16 * n:
+            buffer.close()
+            return None
+        view = memoryview(buffer)[COLUMNS_CACHE_HEADER.size:]
+        return RatingColumns(user=view[0:4 * n].cast('i'),
+                             item=view[4 * n:8 * n].cast('i'),
+                             timestamp=view[8 * n:12 * n].cast('i'),
+                             rating=view[12 * n:16 * n].cast('f'))
+
     @classmethod
     def parse_line(cls, line: str, sep: str):
         """
@@ -95,7 +311,7 @@ class DataSet:
         return user, movie, rate
 
     @classmethod
-    def train_test_split(cls, ratings, test_size=0.2):
+    def train_test_split(cls, ratings, test_size=0.2, compact=False, seed=None):
         """
         Split rating data to training set and test set.
 
@@ -105,13 +321,17 @@ class DataSet:
 
         :param ratings: raw dataset
         :param test_size: the percentage of test size.
+        :param compact: return InteractionStore instead of dict of dicts.
+        :param seed: random seed of a private random.Random, None to use the random module.
+                     seed 0 gives the same split as the random module right after import.
         :return: train_set and test_set
         """
+        rng = random if seed is None else random.Random(seed)
         train, test = collections.defaultdict(dict), collections.defaultdict(dict)
         trainset_len = 0
         testset_len = 0
         for user, movie, rate in ratings:
-            if random.random() <= test_size:
+            if rng.random() <= test_size:
                 test[user][movie] = int(rate)
                 testset_len += 1
             else:
@@ -120,4 +340,342 @@ class DataSet:
         print('split rating data to training set and test set success.')
         print('train set size = %s' % trainset_len)
         print('test set size = %s\n' % testset_len)
+        if compact:
+            return InteractionStore.from_dict(train), InteractionStore.from_dict(test)
+        return train, test
+
+    @classmethod
+    def split_columns(cls, columns: RatingColumns, strategy='random', test_size=0.2, n_last=1, cutoff=None,
+                      seed=0, compact=False):
+        """
+        Split columnar rating data to training set and test set.
+
+        Random numbers come from a private random.Random(seed),
+        so the split doesn't depend on any other use of the random module.
+
+        Strategies:
+            'random': every rating goes to test set with probability test_size.
+            'user': test_size of each user's ratings, chosen randomly, go to test set.
+                    Users always keep at least one rating in training set.
+            'leave_last': the last n_last ratings of each user by timestamp go to test set.
+                          Users always keep at least one rating in training set.
+            'temporal': ratings at or after cutoff timestamp go to test set.
+                        cutoff defaults to the timestamp that leaves test_size of ratings after it.
+
+        :param columns: RatingColumns, e.g. :meth:`load_columns`.
+        :param strategy: 'random', 'user', 'leave_last' or 'temporal'.
+        :param test_size: the percentage of test size.
+        :param n_last: ratings number of each user in test set for 'leave_last'.
+        :param cutoff: timestamp for 'temporal'.
+        :param seed: random seed.
+        :param compact: return InteractionStore instead of dict of dicts.
+        :return: train_set and test_set
+        """
+        rng = random.Random(seed)
+        n = len(columns.user)
+        if strategy == 'random':
+            is_test = random_mask(rng, n, test_size)
+        elif strategy in ('user', 'leave_last'):
+            user_rows = collections.defaultdict(list)
+            for k, user in enumerate(columns.user):
+                user_rows[user].append(k)
+            is_test = bytearray(n)
+            timestamp = columns.timestamp
+            for rows in user_rows.values():
+                if strategy == 'user':
+                    test_rows = rng.sample(rows, min(int(round(test_size * len(rows))), len(rows) - 1))
+                else:
+                    rows.sort(key=lambda k: (timestamp[k], k))
+                    test_rows = rows[len(rows) - min(n_last, len(rows) - 1):]
+                for k in test_rows:
+                    is_test[k] = 1
+        elif strategy == 'temporal':
+            if cutoff is None:
+                cutoff = sorted(columns.timestamp)[min(n - 1, int(n * (1 - test_size)))]
+            is_test = bytearray(t >= cutoff for t in columns.timestamp)
+        else:
+            raise ValueError('unknown split strategy ' + strategy +
+                             ". Accepted values are 'random', 'user', 'leave_last' and 'temporal'.")
+
+        # ids are strings in trainset, as parse_line returns.
+        user_ids = {user: str(user) for user in set(columns.user)}
+        movie_ids = {movie: str(movie) for movie in set(columns.item)}
+        # whole star ratings are ints in trainset, as train_test_split returns.
+        rates = {rate: int(rate) if rate.is_integer() else rate for rate in set(columns.rating)}
+        rows = zip(map(user_ids.__getitem__, columns.user), map(movie_ids.__getitem__, columns.item),
+                   map(rates.__getitem__, columns.rating))
+        if compact:
+            # packed straight from the columns, no dict of dicts is built.
+            split = StreamingSplit()
+            split.extend(rows, is_test)
+            train, test = split.finish()
+        else:
+            train, test = collections.defaultdict(dict), collections.defaultdict(dict)
+            for (user, movie, rate), in_test in zip(rows, is_test):
+                (test if in_test else train)[user][movie] = rate
+        testset_len = sum(is_test)
+        print('split rating data to training set and test set success.')
+        print('train set size = %s' % (n - testset_len))
+        print('test set size = %s\n' % testset_len)
         return train, test
+
+    @classmethod
+    def train_test_split_stream(cls, chunks, test_size=0.2, seed=None):
+        """
+        Split chunks of rating data to training set and test set.
+
+        Ratings are split one by one in the same order and with the same random numbers
+        as :meth:`train_test_split`, so both give the same split.
+
+        :param chunks: iterable of lists of ratings, e.g. :meth:`load_dataset_chunks`.
+        :param test_size: the percentage of test size.
+        :param seed: random seed, see :meth:`train_test_split`.
+        :return: StreamingSplit, its trainset and testset are InteractionStore.
+        """
+        split = StreamingSplit(test_size, seed)
+        for chunk in chunks:
+            split.update(chunk)
+        split.finish()
+        print('split rating data to training set and test set success.')
+        print('train set size = %s' % split.trainset_len)
+        print('test set size = %s\n' % split.testset_len)
+        return split
+
+
+class StreamingSplit:
+    """
+    Incremental split of ratings to training set and test set.
+    Each chunk is appended to flat arrays of user ids, movie ids and ratings,
+    and finish() packs them into a compact InteractionStore for each set,
+    so neither the whole ratings list nor a dict of dicts is held in memory.
+    Movie popularity in training set is counted from the packed trainset.
+    """
+
+    def __init__(self, test_size=0.2, seed=None):
+        self.test_size = test_size
+        self.rng = random if seed is None else random.Random(seed)
+        self.user_index, self.movie_index = IdIndex(), IdIndex()
+        # (users, movies, ratings) of training set and test set, users and movies are inner ids.
+        self.parts = tuple((array('i'), array('i'), array('f')) for _ in range(2))
+        self.trainset, self.testset = None, None
+        self.movie_popular = None
+
+    @property
+    def trainset_len(self):
+        return len(self.parts[0][0]) if self.trainset is None else self.trainset.indptr[-1]
+
+    @property
+    def testset_len(self):
+        return len(self.parts[1][0]) if self.testset is None else self.testset.indptr[-1]
+
+    def update(self, chunk):
+        """
+        Split a chunk of ratings.
+        :param chunk: list of (user, movie, rate)
+        :return: None
+        """
+        rng, test_size = self.rng.random, self.test_size
+        self.extend(chunk, [rng() <= test_size for _ in chunk])
+
+    def extend(self, chunk, is_test):
+        """
+        Add a chunk of ratings which are already split.
+        :param chunk: iterable of (user, movie, rate)
+        :param is_test: whether each rating goes to test set.
+        :return: None
+        """
+        add_user, add_movie = self.user_index.add, self.movie_index.add
+        for (user, movie, rate), in_test in zip(chunk, is_test):
+            users, movies, ratings = self.parts[in_test]
+            users.append(add_user(user))
+            movies.append(add_movie(movie))
+            ratings.append(float(rate))
+
+    def finish(self):
+        """
+        Pack the ratings fed so far into training set and test set.
+        :return: trainset and testset, both InteractionStore.
+        """
+        self.trainset, self.testset = (self.pack(*part) for part in self.parts)
+        self.parts = tuple((array('i'), array('i'), array('f')) for _ in range(2))
+        counts = collections.Counter(self.trainset.indices)
+        self.movie_popular = {movie: counts[i] for i, movie in enumerate(self.trainset.movie_index)}
+        return self.trainset, self.testset
+
+    def pack(self, users, movies, ratings):
+        """
+        Group the ratings of one set by user with a stable counting sort.
+        :return: InteractionStore, rows and ids in the same order as InteractionStore.from_dict gives.
+        """
+        user_raw_ids, movie_raw_ids = self.user_index.raw_ids, self.movie_index.raw_ids
+        user_index = IdIndex()
+        rows = array('i', [user_index.add(user_raw_ids[u]) for u in users])
+        n_users = len(user_index)
+        starts = array('q', bytes(8 * (n_users + 1)))
+        for u in rows:
+            starts[u + 1] += 1
+        for u in range(n_users):
+            starts[u + 1] += starts[u]
+        order, next_pos = array('q', bytes(8 * len(rows))), starts[:-1]
+        for k, u in enumerate(rows):
+            order[next_pos[u]] = k
+            next_pos[u] += 1
+        del rows, next_pos
+
+        def user_rows():
+            for u, user in enumerate(user_index):
+                # a later rating of the same movie replaces the earlier one, as in a dict.
+                row = {}
+                for k in order[starts[u]:starts[u + 1]]:
+                    rate = ratings[k]
+                    row[movie_raw_ids[movies[k]]] = int(rate) if rate.is_integer() else rate
+                yield user, row
+
+        return InteractionStore.from_rows(user_rows())
+
+
+class InteractionStore(Mapping):
+    """
+    Compact read-only store of {user: {movie: rating}} backed by CSR arrays.
+
+    Movies of user u are movie_index ids indices[indptr[u]:indptr[u + 1]] with int8 ratings,
+    or float32 ratings if any rating is a half star, kept in the order they were added.
+    sorted_indices holds the same ids sorted in each row, and sorted_positions their positions in the row,
+    so `movie in store[user]` and `store[user][movie]` are binary searches.
+    It has the same read API as the dict of dicts returned by train_test_split,
+    so every model can use it as trainset or testset.
+    """
+
+    def __init__(self, user_index: IdIndex, movie_index: IdIndex, indptr, indices, ratings, sorted_indices=None,
+                 sorted_positions=None):
+        self.user_index = user_index
+        self.movie_index = movie_index
+        self.indptr = indptr
+        self.indices = indices
+        self.ratings = ratings
+        self.sorted_indices = sorted_indices
+        self.sorted_positions = sorted_positions
+        if sorted_indices is None or sorted_positions is None:
+            self.sorted_indices, positions = array(indices.typecode), []
+            for u in range(len(user_index)):
+                row = indices[indptr[u]:indptr[u + 1]]
+                order = sorted(range(len(row)), key=row.__getitem__)
+                self.sorted_indices.extend([row[k] for k in order])
+                positions.extend(order)
+            longest = max((indptr[u + 1] - indptr[u] for u in range(len(user_index))), default=0)
+            self.sorted_positions = array('H' if longest <= 2 ** 16 else 'i', positions)
+
+    @classmethod
+    def from_dict(cls, trainset):
+        """
+        Build a store from a dict of dicts.
+        :param trainset: {user: {movie: rating}}
+        :return: InteractionStore
+        """
+        return cls.from_rows(trainset.items())
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a store one user at a time.
+        :param rows: iterable of (user, {movie: rating}), each user once.
+        :return: InteractionStore
+        """
+        user_index, movie_index = IdIndex(), IdIndex()
+        indptr, indices, ratings = array('q', [0]), array('i'), array('f')
+        whole_stars = True
+        for user, movies in rows:
+            user_index.add(user)
+            indices.extend([movie_index.add(movie) for movie in movies])
+            ratings.extend(movies.values())
+            whole_stars = whole_stars and all(type(rating) is int for rating in movies.values())
+            indptr.append(len(indices))
+        # 2 bytes for each movie id are enough for all MovieLens datasets.
+        if len(movie_index) < 2 ** 16:
+            indices = array('H', indices)
+        # whole star ratings fit in int8, half-star ratings are kept as float32.
+        if whole_stars:
+            ratings = array('b', map(int, ratings))
+        return cls(user_index, movie_index, indptr, indices, ratings)
+
+    def to_arrays(self):
+        return {'user_index': self.user_index, 'movie_index': self.movie_index, 'indptr': self.indptr,
+                'indices': self.indices, 'ratings': self.ratings, 'sorted_indices': self.sorted_indices,
+                'sorted_positions': self.sorted_positions}
+
+    @classmethod
+    def from_arrays(cls, fields):
+        return cls(**fields)
+
+    def to_csr(self):
+        """
+        :return: users index, movies index and the CSR user-movie rating matrix.
+        """
+        return self.user_index, self.movie_index, \
+            CSRMatrix(self.indptr, self.indices, self.ratings, len(self.movie_index))
+
+    def __getitem__(self, user):
+        return UserRatings(self, self.user_index.to_inner(user))
+
+    def __contains__(self, user):
+        return user in self.user_index
+
+    def __iter__(self):
+        return iter(self.user_index)
+
+    def __len__(self):
+        return len(self.user_index)
+
+    def __getstate__(self):
+        # sorted_indices and sorted_positions are rebuilt on load.
+        return self.user_index, self.movie_index, self.indptr, self.indices, self.ratings
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class UserRatings(Mapping):
+    """
+    Read-only view of {movie: rating} of a user in an InteractionStore.
+    """
+    __slots__ = ('store', 'start', 'end')
+
+    def __init__(self, store: InteractionStore, u):
+        self.store = store
+        self.start, self.end = store.indptr[u], store.indptr[u + 1]
+
+    def find(self, movie):
+        """
+        :param movie: raw movie id.
+        :return: position of the movie in sorted_indices if the user has rated it, else None.
+        """
+        i = self.store.movie_index.inner_ids.get(movie)
+        if i is None:
+            return None
+        sorted_indices = self.store.sorted_indices
+        k = bisect.bisect_left(sorted_indices, i, self.start, self.end)
+        return k if k < self.end and sorted_indices[k] == i else None
+
+    def __getitem__(self, movie):
+        k = self.find(movie)
+        if k is None:
+            raise KeyError(movie)
+        return self.store.ratings[self.start + self.store.sorted_positions[k]]
+
+    def __contains__(self, movie):
+        return self.find(movie) is not None
+
+    def __iter__(self):
+        raw_ids = self.store.movie_index.raw_ids
+        return (raw_ids[i] for i in self.store.indices[self.start:self.end])
+
+    def __len__(self):
+        return self.end - self.start
+
+    def items(self):
+        raw_ids = self.store.movie_index.raw_ids
+        return [(raw_ids[i], rating) for i, rating in zip(self.store.indices[self.start:self.end],
+                                                         self.store.ratings[self.start:self.end])]
+
+    def values(self):
+        return self.store.ratings[self.start:self.end].tolist()
@@ -0,0 +1,165 @@
+# -*- coding = utf-8 -*-
+"""
+Evaluate recommendation models on testset.
+
+:class:`Evaluator` is shared by the test() method of every model.
+It computes precision, recall, coverage, popularity, NDCG@N and MAP@N
+in one pass over the recommendations, and returns an :class:`EvaluationResult`.
+
+Users can be sharded across a pool of forked processes,
+every process computes partial metric sums of its shard
+and the partial sums are merged into the same numbers as the serial loop.
+"""
+import math
+import multiprocessing
+import time
+from collections import namedtuple
+
+import instrument
+
+EvaluationResult = namedtuple('EvaluationResult', ['precision', 'recall', 'coverage', 'popularity',
+                                                   'ndcg', 'map', 'n_users', 'seconds'])
+
+# (evaluator, model, users) shared with forked worker processes.
+# Workers read it from the parent's memory, so the model is never pickled.
+_shared_state = None
+
+
+def _evaluate_shard(bounds):
+    evaluator, model, users = _shared_state
+    start, end = bounds
+    return evaluator.evaluate_users(model, users[start:end])
+
+
+class Evaluator:
+    """
+    Evaluate any model with n_rec_movie and recommend(user).
+    recommend_batch(users) is used instead if the model has it.
+    """
+
+    def __init__(self, testset, movie_popular, movie_count):
+        """
+        :param testset: test dataset
+        :param movie_popular: popularity of each movie in trainset.
+        :param movie_count: total movie number, which is used by coverage.
+        """
+        self.testset = testset
+        self.movie_count = movie_count
+        # popularity is log(1 + popular), computed once for each movie.
+        self.log_popular = {movie: math.log(1 + popular) for movie, popular in movie_popular.items()}
+        # discounts[rank] is the DCG discount of a hit at rank.
+        self.discounts = []
+
+    def discount(self, rank):
+        """
+        :param rank: 0-based rank in recommend list.
+        :return: 1 / log2(rank + 2)
+        """
+        while len(self.discounts) <= rank:
+            self.discounts.append(1 / math.log2(len(self.discounts) + 2))
+        return self.discounts[rank]
+
+    def evaluate_users(self, model, users):
+        """
+        Recommend movies to users and count the partial sums of metrics.
+        :param model: model with n_rec_movie and recommend(user) or recommend_batch(users)
+        :param users: users to recommend to.
+        :return: hit, rec_count, test_count, recommended movies set, popularity terms,
+                 NDCG terms and AP terms of users with test movies.
+        """
+        N = model.n_rec_movie
+        log_popular = self.log_popular
+        #  varables for precision and recall
+        hit = 0
+        rec_count = 0
+        test_count = 0
+        # varables for coverage
+        all_rec_movies = set()
+        # varables for popularity, ndcg and map
+        popular_terms, ndcg_terms, ap_terms = [], [], []
+        users = list(users)
+        with instrument.span('evaluation.recommend'):
+            if hasattr(model, 'recommend_batch'):
+                rec_lists = model.recommend_batch(users, N)[0]
+            else:
+                rec_lists = [model.recommend(user) for user in users]
+        instrument.count('evaluation.users', len(users))
+        for user, rec_movies in zip(users, rec_lists):
+            test_movies = self.testset.get(user, {})
+            user_hit = 0
+            dcg, precision_sum = 0.0, 0.0
+            for rank, movie in enumerate(rec_movies):
+                if movie in test_movies:
+                    user_hit += 1
+                    dcg += self.discount(rank)
+                    precision_sum += user_hit / (rank + 1)
+                all_rec_movies.add(movie)
+                popular_terms.append(log_popular[movie])
+            if test_movies:
+                n_relevant = min(N, len(test_movies))
+                ndcg_terms.append(dcg / sum(self.discount(rank) for rank in range(n_relevant)))
+                ap_terms.append(precision_sum / n_relevant)
+            hit += user_hit
+            rec_count += N
+            test_count += len(test_movies)
+        return hit, rec_count, test_count, all_rec_movies, popular_terms, ndcg_terms, ap_terms
+
+    def evaluate(self, model, users, n_jobs=1):
+        """
+        Evaluate model by precision, recall, coverage, popularity, NDCG@N and MAP@N.
+
+        With n_jobs > 1, users are split into contiguous shards evaluated by forked processes.
+        Shards are merged in order, so the metrics are exactly the same as the serial path
+        as long as model.recommend is deterministic (RandomPredict is not).
+
+        :param model: model with n_rec_movie and recommend(user)
+        :param users: users to recommend to.
+        :param n_jobs: number of worker processes.
+        :return: EvaluationResult
+        """
+        global _shared_state
+        users = list(users)
+        # record the calculate time has spent.
+        start = time.perf_counter()
+        if n_jobs <= 1:
+            parts = [self.evaluate_users(model, users)]
+        else:
+            # spans of worker processes are lost, the whole pool is recorded as evaluation.recommend.
+            shard_size = max(1, math.ceil(len(users) / (4 * n_jobs)))
+            shards = [(start, min(start + shard_size, len(users))) for start in range(0, len(users), shard_size)]
+            _shared_state = self, model, users
+            try:
+                with multiprocessing.get_context('fork').Pool(n_jobs) as pool, \
+                        instrument.span('evaluation.recommend'):
+                    parts = pool.map(_evaluate_shard, shards)
+            finally:
+                _shared_state = None
+            instrument.count('evaluation.users', len(users))
+
+        hit, rec_count, test_count = 0, 0, 0
+        all_rec_movies, popular_terms, ndcg_terms, ap_terms = set(), [], [], []
+        for part_hit, part_rec_count, part_test_count, part_rec_movies, \
+                part_popular_terms, part_ndcg_terms, part_ap_terms in parts:
+            hit += part_hit
+            rec_count += part_rec_count
+            test_count += part_test_count
+            all_rec_movies |= part_rec_movies
+            popular_terms.extend(part_popular_terms)
+            ndcg_terms.extend(part_ndcg_terms)
+            ap_terms.extend(part_ap_terms)
+        popular_sum = 0
+        for term in popular_terms:
+            popular_sum += term
+
+        seconds = time.perf_counter() - start
+        instrument.record('evaluation', seconds)
+        print('Test recommendation system success.')
+        print('total %d users, %.2f seconds have spent\n' % (len(users), seconds))
+        return EvaluationResult(precision=hit / (1.0 * rec_count),
+                                recall=hit / (1.0 * test_count),
+                                coverage=len(all_rec_movies) / (1.0 * self.movie_count),
+                                popularity=popular_sum / (1.0 * rec_count),
+                                ndcg=math.fsum(ndcg_terms) / max(1, len(ndcg_terms)),
+                                map=math.fsum(ap_terms) / max(1, len(ap_terms)),
+                                n_users=len(users),
+                                seconds=seconds)
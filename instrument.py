@@ -0,0 +1,259 @@
+# -*- coding = utf-8 -*-
+"""
+Named spans and counters to profile where models spend their time.
+
+    with instrument.span('similarity.cooccurrence'):
+        ...
+    instrument.count('evaluation.users', len(users))
+
+Instrumentation is disabled by default. Then span() returns one shared no-op context manager
+and count() returns at once, so instrumented code only pays a function call.
+After :func:`enable`, the count, total, min and max seconds of each span and the value of each counter
+are aggregated, and can be exported as JSON or as Prometheus text format.
+
+:func:`profile` wraps a block with a span and optionally captures cProfile stats
+and tracemalloc peak memory, see main.run_model.
+"""
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+_enabled = False
+# name: [count, total seconds, min seconds, max seconds]
+_spans = {}
+# name: value
+_counters = {}
+_gauges = {}
+# spans and counters can be recorded by threads of the server.
+_lock = threading.Lock()
+
+
+class _NoSpan:
+    """
+    Span returned while instrumentation is disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    """
+    Time a block and add it to the span of the name.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Drop all recorded spans, counters and gauges.
+    """
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def span(name):
+    """
+    :param name: span name, e.g. 'similarity.cooccurrence'.
+    :return: context manager which times its block.
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return Span(name)
+
+
+def record(name, seconds):
+    """
+    Add a timing to the span of the name, e.g. of a block timed without :func:`span`.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        stat = _spans.get(name)
+        if stat is None:
+            _spans[name] = [1, seconds, seconds, seconds]
+        else:
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = min(stat[2], seconds)
+            stat[3] = max(stat[3], seconds)
+
+
+def count(name, n=1):
+    """
+    Add n to the counter of the name.
+    In a hot loop, count the loop once with its length instead of once per step.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def gauge(name, value):
+    """
+    Set the gauge of the name, e.g. peak memory in bytes.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def timed(name):
+    """
+    Decorator which records every call of a function as a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    :return: dict of spans, counters and gauges recorded so far.
+    """
+    with _lock:
+        return {'spans': {name: {'count': stat[0], 'seconds': stat[1], 'min_seconds': stat[2],
+                                 'max_seconds': stat[3]} for name, stat in sorted(_spans.items())},
+                'counters': dict(sorted(_counters.items())),
+                'gauges': dict(sorted(_gauges.items()))}
+
+
+def _write(text, path):
+    if path is not None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+    return text
+
+
+def to_json(path=None):
+    """
+    :param path: file to write, optional.
+    :return: JSON text of :func:`snapshot`.
+    """
+    return _write(json.dumps(snapshot(), indent=1), path)
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(path=None, prefix='movielens'):
+    """
+    :param path: file to write, optional, e.g. for the textfile collector of node exporter.
+    :param prefix: prefix of metric names.
+    :return: Prometheus text format of :func:`snapshot`.
+    """
+    data = snapshot()
+    lines = []
+    metrics = [('span_seconds_total', 'counter', 'Total seconds spent in each span.', 'span',
+                {name: stat['seconds'] for name, stat in data['spans'].items()}),
+               ('span_calls_total', 'counter', 'Number of times each span was entered.', 'span',
+                {name: stat['count'] for name, stat in data['spans'].items()}),
+               ('span_max_seconds', 'gauge', 'Longest time of each span.', 'span',
+                {name: stat['max_seconds'] for name, stat in data['spans'].items()}),
+               ('events_total', 'counter', 'Value of each counter.', 'counter', data['counters']),
+               ('gauge', 'gauge', 'Value of each gauge.', 'gauge', data['gauges'])]
+    for metric, metric_type, help_text, label, values in metrics:
+        if not values:
+            continue
+        lines.append('# HELP %s_%s %s' % (prefix, metric, help_text))
+        lines.append('# TYPE %s_%s %s' % (prefix, metric, metric_type))
+        lines.extend('%s_%s{%s="%s"} %s' % (prefix, metric, label, _label(name), repr(float(value)))
+                     for name, value in values.items())
+    return _write('\n'.join(lines) + '\n', path)
+
+
+@contextlib.contextmanager
+def profile(name, cprofile=False, trace_memory=False, output_dir='profile', top=20):
+    """
+    Record a block as a span, and optionally profile it.
+    :param name: span name, and the file name of the cProfile stats.
+    :param cprofile: capture cProfile stats, which are saved to output_dir/<name>.prof
+                     and the top functions by cumulative time are printed.
+    :param trace_memory: trace allocations with tracemalloc, the peak is recorded as gauge <name>.peak_bytes
+                         and the top allocating lines are printed.
+    :param output_dir: directory of cProfile stats.
+    :param top: number of printed functions and lines.
+    """
+    profiler = cProfile.Profile() if cprofile else None
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if trace_memory:
+        tracemalloc.reset_peak()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with span(name):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(output_dir, exist_ok=True)
+            stats_path = os.path.join(output_dir, name + '.prof')
+            profiler.dump_stats(stats_path)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            print('cProfile of %s is saved to %s.\n%s' % (name, stats_path, stream.getvalue()))
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            top_lines = tracemalloc.take_snapshot().statistics('lineno')[:top]
+            if started_tracing:
+                tracemalloc.stop()
+            gauge(name + '.peak_bytes', peak)
+            print('tracemalloc peak of %s is %.1f MB, top allocations:' % (name, peak / 2 ** 20))
+            for line in top_lines:
+                print(line)
+            print()
@@ -6,9 +6,10 @@ Created on 2018-04-16
 
 @author: fuxuemingzhu
 """
+import instrument
 import utils
 from ItemCF import ItemBasedCF
-from LFM import LFM
+from LFM import LFM, ArrayLFM
 from UserCF import UserBasedCF
 from dataset import DataSet
 from most_popular import MostPopular
@@ -16,22 +17,75 @@ from random_pred import RandomPredict
 from utils import LogTime
 
 
-def run_model(model_name, dataset_name, test_size=0.3, clean=False):
+def run_model(model_name, dataset_name, test_size=0.3, clean=False, n_jobs=1, compact=False, cache_budget=None,
+              metrics_path=None, profile=False, trace_memory=False):
+    """
+    Fit a model and test it.
+    :param metrics_path: record spans and counters, and write them to <metrics_path>.json
+                         and <metrics_path>.prom in Prometheus text format.
+    :param profile: capture cProfile stats of fit and test, which are saved under profile/.
+    :param trace_memory: trace the peak memory of fit and test with tracemalloc.
+                         Spans and counters of earlier runs are dropped, and recording is switched back off
+                         when the run ends unless it was already on.
+    :return: EvaluationResult
+    """
     print('*' * 70)
     print('\tThis is %s model trained on %s with test_size = %.2f' % (model_name, dataset_name, test_size))
     print('*' * 70 + '\n')
-    model_manager = utils.ModelManager(dataset_name, test_size)
+    instrument.reset()
+    was_enabled = instrument.is_enabled()
+    if metrics_path is not None or profile or trace_memory:
+        instrument.enable()
+    try:
+        with instrument.profile('fit', profile, trace_memory):
+            model, testset = fit_model(model_name, dataset_name, test_size, clean, compact, cache_budget)
+        recommend_test(model, [1, 100, 233, 666, 888])
+        with instrument.profile('test', profile, trace_memory):
+            result = model.test(testset, n_jobs=n_jobs)
+        if metrics_path is not None:
+            instrument.to_json(metrics_path + '.json')
+            instrument.to_prometheus(metrics_path + '.prom')
+            print('Metrics are written to %s.json and %s.prom.' % (metrics_path, metrics_path))
+    finally:
+        if not was_enabled:
+            instrument.disable()
+    return result
+
+
+def fit_model(model_name, dataset_name, test_size=0.3, clean=False, compact=False, cache_budget=None, seed=0,
+              strategy='random'):
+    """
+    Split the dataset and fit a model, both are loaded from model/ cache if they have been saved.
+    The dataset is loaded as typed columns and split with DataSet.split_columns.
+    :param seed: random seed of the split, part of the cache key of trainset and testset.
+    :param strategy: split strategy, see DataSet.split_columns.
+    :return: fitted model and testset
+    """
+    '''Splits are cached by the dataset file and split params, models by the trainset and model params.'''
+    '''Do you want to split and retrain model again?'''
+    '''if you want to retrain model, please set clean True, only the entries of this split and model are removed.'''
+    model_manager = utils.ModelManager(dataset_name, test_size,
+                                       dataset_path=DataSet.get_builtin_dataset(dataset_name).path,
+                                       disk_budget=cache_budget, compact=compact, seed=seed,
+                                       strategy=strategy)
+    if clean:
+        model_manager.clean_entry()
     try:
         trainset = model_manager.load_model('trainset')
         testset = model_manager.load_model('testset')
     except OSError:
-        ratings = DataSet.load_dataset(name=dataset_name)
-        trainset, testset = DataSet.train_test_split(ratings, test_size=test_size)
+        columns = DataSet.load_columns(name=dataset_name)
+        trainset, testset = DataSet.split_columns(columns, strategy, test_size, seed=seed, compact=compact)
         model_manager.save_model(trainset, 'trainset')
         model_manager.save_model(testset, 'testset')
-    '''Do you want to clean workspace and retrain model again?'''
-    '''if you want to change test_size or retrain model, please set clean_workspace True'''
-    model_manager.clean_workspace(clean)
+    model = create_model(model_name)
+    if clean:
+        utils.ModelManager(params=model.cache_params(), trainset=trainset).clean_entry()
+    model.fit(trainset)
+    return model, testset
+
+
+def create_model(model_name):
     if model_name == 'UserCF':
         model = UserBasedCF()
     elif model_name == 'ItemCF':
@@ -47,11 +101,11 @@ def run_model(model_name, dataset_name, test_size=0.3, clean=False):
     elif model_name == 'LFM':
         # K, epochs, alpha, lamb, n_rec_movie
         model = LFM(10, 20, 0.1, 0.01, 10)
+    elif model_name == 'LFM-Array':
+        model = ArrayLFM(10, 20, 0.1, 0.01, 10)
     else:
         raise ValueError('No model named ' + model_name)
-    model.fit(trainset)
-    recommend_test(model, [1, 100, 233, 666, 888])
-    model.test(testset)
+    return model
 
 
 def recommend_test(model, user_list):
@@ -73,6 +127,7 @@ if __name__ == '__main__':
     # model_type = 'MostPopular'
     # model_type = 'ItemCF-IUF'
     # model_type = 'LFM'
+    # model_type = 'LFM-Array'
     test_size = 0.1
     run_model(model_type, dataset_name, test_size, False)
     main_time.finish()
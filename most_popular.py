@@ -11,11 +11,11 @@ Description : Recommend by Most Popular movies.
 """
 import random
 
-import math
-
 from collections import defaultdict
 from operator import itemgetter
 
+import evaluation
+import instrument
 import similarity
 import utils
 
@@ -42,17 +42,16 @@ class MostPopular:
         :param trainset: train dataset
         :return: None
         """
-        model_manager = utils.ModelManager()
+        model_manager = utils.ModelManager(params=self.cache_params(), trainset=trainset)
+        self.trainset = trainset
         try:
             self.movie_popular = model_manager.load_model('movie_popular')
             self.movie_count = model_manager.load_model('movie_count')
-            self.trainset = model_manager.load_model('trainset')
             self.total_movies = model_manager.load_model('total_movies')
             self.movie_popular_sort = model_manager.load_model('movie_popular_sort')
             print('MostPopular model has saved before.\nLoad model success...\n')
         except OSError:
             print('No model saved before.\nTrain a new model...')
-            self.trainset = trainset
             self.movie_popular, self.movie_count = similarity.calculate_movie_popular(trainset)
             self.total_movies = list(self.movie_popular.keys())
             self.movie_popular_sort = sorted(self.movie_popular.items(), key=itemgetter(1), reverse=True)
@@ -64,6 +63,9 @@ class MostPopular:
                 model_manager.save_model(self.movie_popular_sort, 'movie_popular_sort')
                 print('The new model has saved success.\n')
 
+    def cache_params(self):
+        return {'model': 'MostPopular'}
+
     def recommend(self, user):
         """
         Random recommend N movies for the user.
@@ -73,61 +75,54 @@ class MostPopular:
         if not self.n_rec_movie or not self.trainset or not self.movie_popular \
                 or not self.movie_count or not self.movie_popular_sort:
             raise NotImplementedError('MostPopular has not init or fit method has not called yet.')
-        N = self.n_rec_movie
         # Recommend N most popular movies for the user.
-        predict_movies = list()
-        watched_movies = self.trainset[user]
-        for movie, _ in self.movie_popular_sort:
-            if len(predict_movies) < N and movie not in watched_movies:
-                predict_movies.append(movie)
-        return predict_movies
+        return self.recommend_batch([user])[0][0]
+
+    def recommend_batch(self, users, n=None):
+        """
+        Recommend N movies for each user in one call.
+        Walk down the precomputed popularity ranking and skip the movies each user has watched.
+        Results are the same as recommend(user).
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user, best first. Scores are the popularity of movies.
+                 Users not in trainset have watched nothing and get the N most popular movies.
+        """
+        if not self.n_rec_movie or not self.trainset or not self.movie_popular \
+                or not self.movie_count or not self.movie_popular_sort:
+            raise NotImplementedError('MostPopular has not init or fit method has not called yet.')
+        N = n or self.n_rec_movie
+        rec_movies, rec_scores = [], []
+        for user in users:
+            watched_movies = self.trainset[user] if user in self.trainset else ()
+            top = []
+            for movie, popular in self.movie_popular_sort:
+                if movie not in watched_movies:
+                    top.append((movie, popular))
+                    if len(top) >= N:
+                        break
+            rec_movies.append([movie for movie, _ in top])
+            rec_scores.append([popular for _, popular in top])
+        return rec_movies, rec_scores
 
-    def test(self, testset):
+    def test(self, testset, n_jobs=1):
         """
         Test the recommendation system by recommending scores to all users in testset.
         :param testset: test dataset
-        :return:
+        :param n_jobs: number of processes to evaluate users in parallel.
+        :return: EvaluationResult
         """
         if not self.n_rec_movie or not self.trainset or not self.movie_popular \
                 or not self.movie_count or not self.movie_popular_sort:
             raise ValueError('UserCF has not init or fit method has not called yet.')
         self.testset = testset
         print('Test recommendation system start...')
-        N = self.n_rec_movie
-        #  varables for precision and recall
-        hit = 0
-        rec_count = 0
-        test_count = 0
-        # varables for coverage
-        all_rec_movies = set()
-        # varables for popularity
-        popular_sum = 0
-
-        # record the calculate time has spent.
-        test_time = utils.LogTime(print_step=1000)
-        for i, user in enumerate(self.trainset):
-            test_movies = self.testset.get(user, {})
-            rec_movies = self.recommend(user)  # type:list
-            for movie in rec_movies:
-                if movie in test_movies:
-                    hit += 1
-                all_rec_movies.add(movie)
-                popular_sum += math.log(1 + self.movie_popular[movie])
-                # log steps and times.
-            rec_count += N
-            test_count += len(test_movies)
-            # print time per 500 times.
-            test_time.count_time()
-        precision = hit / (1.0 * rec_count)
-        recall = hit / (1.0 * test_count)
-        coverage = len(all_rec_movies) / (1.0 * self.movie_count)
-        popularity = popular_sum / (1.0 * rec_count)
-
-        print('Test recommendation system success.')
-        test_time.finish()
+        evaluator = evaluation.Evaluator(self.testset, self.movie_popular, self.movie_count)
+        result = evaluator.evaluate(self, self.trainset, n_jobs=n_jobs)
 
-        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\n' %
-              (precision, recall, coverage, popularity))
+        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\tndcg=%.4f\tmap=%.4f\n' %
+              (result.precision, result.recall, result.coverage, result.popularity, result.ndcg, result.map))
+        return result
 
     def predict(self, testset):
         """
@@ -137,13 +132,10 @@ class MostPopular:
         """
         movies_recommend = defaultdict(list)
         print('Predict scores start...')
-        # record the calculate time has spent.
-        predict_time = utils.LogTime(print_step=500)
-        for i, user in enumerate(testset):
-            rec_movies = self.recommend(user)  # type:list
-            movies_recommend[user].append(rec_movies)
-            # log steps and times.
-            predict_time.count_time()
+        users = list(testset)
+        with instrument.span('predict'):
+            for user, rec_movies in zip(users, self.recommend_batch(users)[0]):
+                movies_recommend[user].append(rec_movies)
+        instrument.count('predict.users', len(users))
         print('Predict scores success.')
-        predict_time.finish()
         return movies_recommend
@@ -11,10 +11,10 @@ Description : Recommend via Random Choice.
 """
 import random
 
-import math
-
 from collections import defaultdict
 
+import evaluation
+import instrument
 import similarity
 import utils
 
@@ -41,16 +41,15 @@ class RandomPredict:
         :param trainset: train dataset
         :return: None
         """
-        model_manager = utils.ModelManager()
+        model_manager = utils.ModelManager(params=self.cache_params(), trainset=trainset)
+        self.trainset = trainset
         try:
             self.movie_popular = model_manager.load_model('movie_popular')
             self.movie_count = model_manager.load_model('movie_count')
-            self.trainset = model_manager.load_model('trainset')
             self.total_movies = model_manager.load_model('total_movies')
             print('RandomPredict model has saved before.\nLoad model success...\n')
         except OSError:
             print('No model saved before.\nTrain a new model...')
-            self.trainset = trainset
             self.movie_popular, self.movie_count = similarity.calculate_movie_popular(trainset)
             self.total_movies = list(self.movie_popular.keys())
             print('Train a new model success.')
@@ -60,6 +59,9 @@ class RandomPredict:
                 model_manager.save_model(self.total_movies, 'total_movies')
                 print('The new model has saved success.\n')
 
+    def cache_params(self):
+        return {'model': 'RandomPredict'}
+
     def recommend(self, user):
         """
         Random recommend N movies for the user.
@@ -78,51 +80,50 @@ class RandomPredict:
                 predict_movies.append(movie)
         return predict_movies[:N]
 
-    def test(self, testset):
+    def recommend_batch(self, users, n=None):
+        """
+        Random recommend N movies for each user in one call.
+        :param users: users we recommend movies to.
+        :param n: number of movies to recommend, n_rec_movie by default.
+        :return: (movies, scores), one list per user. Random movies have no score, so scores are all 0.
+                 Users not in trainset get empty lists.
+        """
+        if not self.n_rec_movie or not self.trainset or not self.movie_popular or not self.movie_count:
+            raise NotImplementedError('RandomPredict has not init or fit method has not called yet.')
+        N = n or self.n_rec_movie
+        rec_movies, rec_scores = [], []
+        for user in users:
+            if user not in self.trainset:
+                rec_movies.append([])
+                rec_scores.append([])
+                continue
+            predict_movies = list()
+            watched_movies = self.trainset[user]
+            while len(predict_movies) < N:
+                movie = random.choice(self.total_movies)
+                if movie not in watched_movies:
+                    predict_movies.append(movie)
+            rec_movies.append(predict_movies)
+            rec_scores.append([0.0] * N)
+        return rec_movies, rec_scores
+
+    def test(self, testset, n_jobs=1):
         """
         Test the recommendation system by recommending scores to all users in testset.
         :param testset: test dataset
-        :return:
+        :param n_jobs: number of processes to evaluate users in parallel.
+        :return: EvaluationResult
         """
         if not self.n_rec_movie or not self.trainset or not self.movie_popular or not self.movie_count:
             raise ValueError('UserCF has not init or fit method has not called yet.')
         self.testset = testset
         print('Test recommendation system start...')
-        N = self.n_rec_movie
-        #  varables for precision and recall
-        hit = 0
-        rec_count = 0
-        test_count = 0
-        # varables for coverage
-        all_rec_movies = set()
-        # varables for popularity
-        popular_sum = 0
-
-        # record the calculate time has spent.
-        test_time = utils.LogTime(print_step=1000)
-        for i, user in enumerate(self.trainset):
-            test_movies = self.testset.get(user, {})
-            rec_movies = self.recommend(user)  # type:list
-            for movie in rec_movies:
-                if movie in test_movies:
-                    hit += 1
-                all_rec_movies.add(movie)
-                popular_sum += math.log(1 + self.movie_popular[movie])
-                # log steps and times.
-            rec_count += N
-            test_count += len(test_movies)
-            # print time per 500 times.
-            test_time.count_time()
-        precision = hit / (1.0 * rec_count)
-        recall = hit / (1.0 * test_count)
-        coverage = len(all_rec_movies) / (1.0 * self.movie_count)
-        popularity = popular_sum / (1.0 * rec_count)
-
-        print('Test recommendation system success.')
-        test_time.finish()
+        evaluator = evaluation.Evaluator(self.testset, self.movie_popular, self.movie_count)
+        result = evaluator.evaluate(self, self.trainset, n_jobs=n_jobs)
 
-        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\n' %
-              (precision, recall, coverage, popularity))
+        print('precision=%.4f\trecall=%.4f\tcoverage=%.4f\tpopularity=%.4f\tndcg=%.4f\tmap=%.4f\n' %
+              (result.precision, result.recall, result.coverage, result.popularity, result.ndcg, result.map))
+        return result
 
     def predict(self, testset):
         """
@@ -132,13 +133,10 @@ class RandomPredict:
         """
         movies_recommend = defaultdict(list)
         print('Predict scores start...')
-        # record the calculate time has spent.
-        predict_time = utils.LogTime(print_step=500)
-        for i, user in enumerate(testset):
-            rec_movies = self.recommend(user)  # type:list
-            movies_recommend[user].append(rec_movies)
-            # log steps and times.
-            predict_time.count_time()
+        users = list(testset)
+        with instrument.span('predict'):
+            for user, rec_movies in zip(users, self.recommend_batch(users)[0]):
+                movies_recommend[user].append(rec_movies)
+        instrument.count('predict.users', len(users))
         print('Predict scores success.')
-        predict_time.finish()
         return movies_recommend
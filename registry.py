@@ -0,0 +1,145 @@
+# -*- coding = utf-8 -*-
+"""
+Replace the model of a running service without downtime.
+
+:class:`ModelRegistry` loads a new version of a model in a background thread
+and swaps it in with one reference assignment. Requests which already took
+the old model finish on it, new requests get the new one.
+
+A reload is started by :meth:`ModelRegistry.reload`, e.g. from a reload command,
+or by :meth:`ModelRegistry.watch` when files of the model change,
+e.g. the dataset file and the cache entry of the model in model/ dir.
+"""
+import os
+import threading
+import time
+import traceback
+
+
+def snapshot(paths, ignore=()):
+    """
+    Fingerprint files and directories by their names, sizes and modification times.
+    Half written files and directories, whose names end with .tmp, are skipped.
+    :param paths: files or directories, missing paths are allowed.
+    :param ignore: names of files which are not model files, e.g. entry.json of a cache entry.
+    :return: hashable snapshot, which changes when any file changes.
+    """
+    state = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names[:] = sorted(name for name in dir_names if not name.endswith('.tmp'))
+                for file_name in sorted(file_names):
+                    if file_name in ignore or file_name.endswith('.tmp'):
+                        continue
+                    file_path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    state.append((file_path, stat.st_size, stat.st_mtime_ns))
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            state.append((path, stat.st_size, stat.st_mtime_ns))
+        else:
+            state.append((path, None, None))
+    return tuple(state)
+
+
+class ModelRegistry:
+    """
+    Hold the current model and load new versions in the background.
+    """
+
+    def __init__(self, loader, on_swap=None):
+        """
+        :param loader: function returning a new model, called in the background thread.
+        :param on_swap: function called with the new model after it is swapped in, e.g. to clear caches.
+        """
+        self.loader = loader
+        self.on_swap = on_swap
+        self.model = None
+        self.version = 0
+        self.loaded_at = None
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.loading = None
+        self.watcher = None
+        self.stopped = threading.Event()
+
+    def load(self):
+        """
+        Load a model in the calling thread and swap it in.
+        :return: the new model
+        """
+        model = self.loader()
+        with self.lock:
+            self.model = model
+            self.version += 1
+            self.loaded_at = time.time()
+            self.last_error = None
+        if self.on_swap is not None:
+            self.on_swap(model)
+        return model
+
+    def reload(self):
+        """
+        Start loading a new model in the background, the current model keeps serving until it is ready.
+        :return: False if a reload is already running.
+        """
+        with self.lock:
+            if self.loading is not None and self.loading.is_alive():
+                return False
+            self.loading = threading.Thread(target=self._reload, name='model-reload', daemon=True)
+            self.loading.start()
+            return True
+
+    def _reload(self):
+        print('Reload model in background...')
+        try:
+            self.load()
+            print('Reload model success, version %d.' % self.version)
+        except Exception:
+            # keep serving the old model.
+            self.last_error = traceback.format_exc()
+            print('Reload model failed, keep the old model.\n' + self.last_error)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the running reload to finish.
+        """
+        loading = self.loading
+        if loading is not None:
+            loading.join(timeout)
+
+    def is_loading(self):
+        return self.loading is not None and self.loading.is_alive()
+
+    def watch(self, paths, interval=5.0, ignore=()):
+        """
+        Reload the model in the background whenever the watched files change.
+        :param paths: function returning files and directories to watch,
+                      called on every check because the paths can change with the model.
+        :param interval: seconds between two checks.
+        :param ignore: names of files whose changes do not trigger a reload.
+        :return: None
+        """
+        def run():
+            last = snapshot(paths(), ignore)
+            while not self.stopped.wait(interval):
+                if self.is_loading() or snapshot(paths(), ignore) == last:
+                    continue
+                print('Model files changed.')
+                self.reload()
+                self.wait()
+                # files saved by the reload itself, e.g. a retrained model, are not a new change.
+                last = snapshot(paths(), ignore)
+        self.watcher = threading.Thread(target=run, name='model-watcher', daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {'version': self.version, 'loaded_at': self.loaded_at, 'loading': self.is_loading(),
+                'last_error': self.last_error}
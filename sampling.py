@@ -0,0 +1,92 @@
+# -*- coding = utf-8 -*-
+"""
+Negative sampling for Latent Factor Model.
+"""
+from array import array
+
+
+class AliasSampler:
+    """
+    Walker's alias method.
+    Draw index i with probability weights[i] / sum(weights) in O(1) per draw.
+    """
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.prob = array('d', [1.0] * n)
+        self.alias = array('i', range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, k, rng):
+        """
+        Draw k indices.
+        The integer part of a uniform number picks a column,
+        and its fraction decides between the column and its alias.
+        :param k: number of draws.
+        :param rng: random.Random instance or the random module.
+        :return: list of indices
+        """
+        n, prob, alias, rand = len(self.prob), self.prob, self.alias, rng.random
+        draws = [rand() * n for _ in range(k)]
+        return [int(u) if u % 1.0 < prob[int(u)] else alias[int(u)] for u in draws]
+
+
+class NegativeSampler:
+    """
+    Draw popularity-proportional negative samples for all users of an epoch at once.
+    The ratio is the same as :meth:`LFM.gen_negative_sample`:
+    up to 11 draws per positive item, and at most 9 distinct unseen negatives per positive item.
+    """
+
+    def __init__(self, positives, item_popular, rng):
+        """
+        :param positives: array of positive item indices of each user index, in the order they are trained.
+        :param item_popular: popularity of each item index.
+        :param rng: random.Random instance or the random module.
+        """
+        self.positives = positives
+        self.alias_sampler = AliasSampler(item_popular)
+        self.rng = rng
+        # marks positive and already drawn items of the current user.
+        self.mask = bytearray(len(item_popular))
+
+    def sample_epoch(self):
+        """
+        Generate positive and negative samples of all users.
+        :return: list of (user index, item index, label)
+        """
+        mask = self.mask
+        draws = self.alias_sampler.sample(11 * sum(len(items) for items in self.positives), self.rng)
+        samples = []
+        offset = 0
+        for u, items in enumerate(self.positives):
+            n_draws, max_negatives = 11 * len(items), 9 * len(items)
+            for i in items:
+                mask[i] = 1
+            negatives = []
+            for i in draws[offset:offset + n_draws]:
+                if not mask[i]:
+                    mask[i] = 1
+                    negatives.append(i)
+                    if len(negatives) >= max_negatives:
+                        break
+            offset += n_draws
+            samples.extend([(u, i, 1) for i in items])
+            samples.extend([(u, i, 0) for i in negatives])
+            for i in items:
+                mask[i] = 0
+            for i in negatives:
+                mask[i] = 0
+        return samples
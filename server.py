@@ -0,0 +1,367 @@
+# -*- coding = utf-8 -*-
+"""
+Serve recommendations over HTTP/JSON from a long-lived process.
+
+A model is fitted (or loaded from model/ cache) once at startup,
+then requests are answered concurrently by a threading HTTP server:
+
+    GET /recommend?user=1&n=10   {"user": "1", "movies": [...], "scores": [...], "cached": false}
+    GET /stats                   model name and version, cache size, hits and misses
+    GET /metrics                 spans and counters in Prometheus text format, with --metrics
+    POST /reload                 load the model again in the background, {"reloading": true}
+
+Results of each (user, n) are kept in an LRU cache with a TTL.
+The model is replaced without downtime by :class:`registry.ModelRegistry`,
+on POST /reload or, with --watch, when the dataset file or the saved model changes.
+Requests keep being answered by the old model until the new one is loaded,
+and the most recently used results are recomputed with the new model before it is swapped in,
+so a reload does not start from a cold cache.
+
+Run a server and benchmark it with p50/p99 latency and QPS:
+
+    python server.py serve --model ItemCF --dataset ml-100k --port 8000 --watch 10
+    python server.py bench --url http://127.0.0.1:8000 --requests 5000 --concurrency 8
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import instrument
+import main
+import storage
+import utils
+from dataset import DataSet
+from registry import ModelRegistry
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, capacity=10000, ttl=300.0):
+        """
+        :param capacity: max number of entries, 0 disables the cache.
+        :param ttl: seconds an entry stays valid, None for never.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: cached value, or None if key is missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if not self.capacity:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def keys(self, limit=None):
+        """
+        :param limit: max number of keys.
+        :return: keys of unexpired entries, most recently used first.
+        """
+        with self.lock:
+            now = time.monotonic()
+            keys = []
+            for key, (created, _) in reversed(self.entries.items()):
+                if limit is not None and len(keys) >= limit:
+                    break
+                if self.ttl is None or now - created < self.ttl:
+                    keys.append(key)
+            return keys
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RecommendService:
+    """
+    Answer recommend(user, n) with a fitted model and a result cache.
+    """
+
+    def __init__(self, model, model_name='', cache=None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache if cache is not None else ResultCache()
+        self.lock = threading.Lock()
+
+    def set_model(self, model, model_name='', warm=0):
+        """
+        Replace the model and drop all cached results of the old one.
+        Requests which already took the old model finish on it.
+        :param warm: number of the most recently used results to recompute with the new model
+                     before it is swapped in, so hot users still hit the cache after a reload.
+        """
+        warmed = self.compute_results(model, self.cache.keys(warm)) if warm else []
+        with self.lock:
+            self.model = model
+            self.model_name = model_name
+            self.cache.clear()
+            # least recently used first, so the cache keeps the order of use.
+            for key, result in reversed(warmed):
+                self.cache.put(key, result)
+
+    @staticmethod
+    def compute_results(model, keys):
+        """
+        Recommend for many (user, n) keys with one recommend_batch call per n.
+        :return: list of (key, result) in the order of keys, unknown users are skipped.
+        """
+        users_of_n = {}
+        for user, n in keys:
+            if user in model.trainset:
+                users_of_n.setdefault(n, []).append(user)
+        results = {}
+        for n, users in users_of_n.items():
+            movies, scores = model.recommend_batch(users, n)
+            for user, user_movies, user_scores in zip(users, movies, scores):
+                results[(user, n)] = {'user': user, 'movies': user_movies, 'scores': user_scores}
+        return [(key, results[key]) for key in keys if key in results]
+
+    def recommend(self, user, n=None):
+        """
+        :param user: raw user id.
+        :param n: number of movies, n_rec_movie of the model by default.
+        :return: dict of user, movies, scores and cached, or None if the user is unknown.
+        """
+        model, cache = self.model, self.cache
+        key = (user, n)
+        result = cache.get(key)
+        if result is not None:
+            instrument.count('server.cache_hits')
+            return dict(result, cached=True)
+        if user not in model.trainset:
+            return None
+        with instrument.span('server.recommend'):
+            movies, scores = model.recommend_batch([user], n)
+        result = {'user': user, 'movies': movies[0], 'scores': scores[0]}
+        # a result of a replaced model must not be cached.
+        with self.lock:
+            if model is self.model:
+                cache.put(key, result)
+        return dict(result, cached=False)
+
+    def stats(self):
+        return {'model': self.model_name, 'cache_size': len(self.cache),
+                'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses}
+
+
+class RecommendHandler(BaseHTTPRequestHandler):
+    """
+    JSON handler of a RecommendService, which is set as server.service.
+    """
+    # keep-alive, so a benchmark client does not pay a TCP handshake per request.
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, Nagle's algorithm would delay the body by an ACK.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        registry = getattr(self.server, 'registry', None)
+        if urlsplit(self.path).path != '/reload':
+            return self.send_json(404, {'error': 'unknown path %s' % self.path})
+        if registry is None:
+            return self.send_json(404, {'error': 'reload is not enabled'})
+        started = registry.reload()
+        return self.send_json(202, {'reloading': True, 'started': started, 'version': registry.version})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        service = self.server.service
+        if url.path == '/recommend':
+            if 'user' not in query:
+                return self.send_json(400, {'error': 'user is required'})
+            try:
+                n = int(query['n'][0]) if 'n' in query else None
+            except ValueError:
+                n = 0
+            if n is not None and n <= 0:
+                return self.send_json(400, {'error': 'n must be a positive integer'})
+            result = service.recommend(query['user'][0], n)
+            if result is None:
+                return self.send_json(404, {'error': 'unknown user %s' % query['user'][0]})
+            return self.send_json(200, result)
+        if url.path == '/metrics':
+            data = instrument.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if url.path == '/stats':
+            registry = getattr(self.server, 'registry', None)
+            return self.send_json(200, dict(service.stats(), **(registry.stats() if registry else {})))
+        return self.send_json(404, {'error': 'unknown path %s' % url.path})
+
+    def send_json(self, status, body):
+        # the body of a POST is not used, but must be read to keep the connection alive.
+        if self.command == 'POST' and self.headers.get('Content-Length'):
+            self.rfile.read(int(self.headers['Content-Length']))
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # access logs would dominate the latency of a benchmark.
+        pass
+
+
+def make_server(service, host='127.0.0.1', port=8000, registry=None):
+    """
+    :param registry: ModelRegistry of the service model, which enables POST /reload.
+    """
+    server = ThreadingHTTPServer((host, port), RecommendHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.registry = registry
+    return server
+
+
+def benchmark(url, users, n_requests=1000, concurrency=4, n=None, seed=0):
+    """
+    Send recommend requests of random users from concurrent keep-alive connections.
+    :param url: server url, e.g. http://127.0.0.1:8000
+    :param users: users to request, drawn with replacement.
+    :param n_requests: total number of requests.
+    :param concurrency: number of client threads.
+    :param n: number of movies of each request.
+    :param seed: seed of the user draws.
+    :return: dict of requests, errors, seconds, qps and p50/p90/p99/max latency in milliseconds.
+    """
+    url = urlsplit(url)
+    rng = random.Random(seed)
+    paths = ['/recommend?user=%s' % user + ('&n=%d' % n if n else '')
+             for user in (rng.choice(users) for _ in range(n_requests))]
+    latencies, errors = [], []
+
+    def worker(worker_paths):
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+        worker_latencies, worker_errors = [], 0
+        for path in worker_paths:
+            start = time.perf_counter()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            worker_latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                worker_errors += 1
+        connection.close()
+        latencies.extend(worker_latencies)
+        errors.append(worker_errors)
+
+    threads = [threading.Thread(target=worker, args=(paths[i::concurrency],)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': sum(errors), 'seconds': seconds,
+            'qps': len(latencies) / seconds,
+            'p50_ms': utils.percentile(latencies, 50) * 1000, 'p90_ms': utils.percentile(latencies, 90) * 1000,
+            'p99_ms': utils.percentile(latencies, 99) * 1000, 'max_ms': latencies[-1] * 1000 if latencies else 0.0}
+
+
+def serve(model_name, dataset_name, test_size=0.1, host='127.0.0.1', port=8000, cache_size=10000, ttl=300.0,
+          watch=None, warm=1000, metrics=False):
+    """
+    :param watch: seconds between checks of the dataset file and the saved model, None to reload on POST only.
+    :param warm: number of cached results recomputed with a reloaded model.
+    :param metrics: record spans and counters, which are exported by GET /metrics.
+    """
+    if metrics:
+        instrument.enable()
+    service = RecommendService(None, model_name, ResultCache(cache_size, ttl))
+    registry = ModelRegistry(lambda: main.fit_model(model_name, dataset_name, test_size)[0],
+                             on_swap=lambda model: service.set_model(model, model_name, warm))
+    registry.load()
+    if watch:
+        dataset_path = DataSet.get_builtin_dataset(dataset_name).path
+        # the cache entry of the model, keyed by the trainset of the last fit_model.
+        # the trainset is hashed once per loaded model, not on every check.
+        entries = {}
+
+        def watched_paths():
+            version, model = registry.version, registry.model
+            if version not in entries:
+                entries.clear()
+                entries[version] = utils.ModelManager(params=model.cache_params(), trainset=model.trainset).path_name
+            return [dataset_path, entries[version]]
+        registry.watch(watched_paths, interval=watch, ignore=(storage.ENTRY_METADATA,))
+    server = make_server(service, host, port, registry)
+    print('Serving %s on http://%s:%d ...' % (model_name, host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        registry.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve or benchmark recommendations over HTTP.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--model', default='ItemCF')
+    serve_parser.add_argument('--dataset', default='ml-100k')
+    serve_parser.add_argument('--test-size', type=float, default=0.1)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--cache-size', type=int, default=10000)
+    serve_parser.add_argument('--ttl', type=float, default=300.0)
+    serve_parser.add_argument('--watch', type=float, default=None,
+                              help='seconds between checks of the model files, reload when they change')
+    serve_parser.add_argument('--warm', type=int, default=1000,
+                              help='number of cached results recomputed with a reloaded model')
+    serve_parser.add_argument('--metrics', action='store_true', help='export spans and counters on /metrics')
+    bench_parser = subparsers.add_parser('bench')
+    bench_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    bench_parser.add_argument('--users', default='1-943', help='range of user ids to request, e.g. 1-943')
+    bench_parser.add_argument('--requests', type=int, default=1000)
+    bench_parser.add_argument('--concurrency', type=int, default=4)
+    bench_parser.add_argument('--n', type=int, default=None)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.model, args.dataset, args.test_size, args.host, args.port, args.cache_size, args.ttl,
+              args.watch, args.warm, args.metrics)
+    else:
+        first, last = args.users.split('-')
+        report = benchmark(args.url, [str(user) for user in range(int(first), int(last) + 1)],
+                           args.requests, args.concurrency, args.n)
+        print(json.dumps(report, indent=1))
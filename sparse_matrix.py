@@ -0,0 +1,321 @@
+# -*- coding = utf-8 -*-
+"""
+Compact sparse matrices backed by the standard :mod:`array` module.
+
+Raw user/movie ids are strings, so :class:`IdIndex` maps them to dense
+integer indices first. Matrices are then stored in CSR form, which is
+much smaller than a dict of dicts and can be multiplied row by row.
+"""
+import math
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from itertools import chain, repeat
+from operator import mul, truediv
+
+from utils import top_n_items
+
+
+class IdIndex:
+    """
+    Two-way mapping between raw ids and dense inner indices.
+    Inner indices are given in the order raw ids are first added.
+    """
+
+    def __init__(self, raw_ids=()):
+        self.raw_ids = []
+        self.inner_ids = {}
+        for raw_id in raw_ids:
+            self.add(raw_id)
+
+    def add(self, raw_id):
+        """
+        Add a raw id if it is not in the index yet.
+        :param raw_id: raw id
+        :return: inner index of the raw id
+        """
+        inner_id = self.inner_ids.get(raw_id)
+        if inner_id is None:
+            inner_id = len(self.raw_ids)
+            self.inner_ids[raw_id] = inner_id
+            self.raw_ids.append(raw_id)
+        return inner_id
+
+    def to_inner(self, raw_id):
+        return self.inner_ids[raw_id]
+
+    def to_raw(self, inner_id):
+        return self.raw_ids[inner_id]
+
+    def __contains__(self, raw_id):
+        return raw_id in self.inner_ids
+
+    def __len__(self):
+        return len(self.raw_ids)
+
+    def __iter__(self):
+        return iter(self.raw_ids)
+
+    def __getstate__(self):
+        # the dict can be rebuilt from raw ids, so only raw ids are pickled.
+        return self.raw_ids
+
+    def __setstate__(self, raw_ids):
+        self.raw_ids = raw_ids
+        self.inner_ids = {raw_id: inner_id for inner_id, raw_id in enumerate(raw_ids)}
+
+    def to_arrays(self):
+        return {'raw_ids': self.raw_ids}
+
+    @classmethod
+    def from_arrays(cls, fields):
+        index = cls.__new__(cls)
+        index.__setstate__(fields['raw_ids'])
+        return index
+
+
+class CSRMatrix:
+    """
+    Compressed sparse row matrix.
+    The column indices and values of row i are
+    indices[indptr[i]:indptr[i + 1]] and data[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, indptr, indices, data, n_cols):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_cols = n_cols
+
+    @classmethod
+    def from_rows(cls, rows, n_cols):
+        """
+        Build a matrix from an iterable of rows.
+        :param rows: iterable of (column indices, values) pairs, one per row.
+        :param n_cols: number of columns.
+        :return: CSRMatrix
+        """
+        indptr, indices, data = array('q', [0]), array('i'), array('d')
+        for row_indices, row_data in rows:
+            indices.extend(row_indices)
+            data.extend(row_data)
+            indptr.append(len(indices))
+        return cls(indptr, indices, data, n_cols)
+
+    def to_arrays(self):
+        return {'indptr': self.indptr, 'indices': self.indices, 'data': self.data, 'n_cols': self.n_cols}
+
+    @classmethod
+    def from_arrays(cls, fields):
+        return cls(fields['indptr'], fields['indices'], fields['data'], fields['n_cols'])
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def row(self, i):
+        """
+        Get row i.
+        :param i: row index
+        :return: (column indices, values) of the row.
+        """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def row_lengths(self):
+        indptr = self.indptr
+        return [indptr[i + 1] - indptr[i] for i in range(self.n_rows)]
+
+    def transpose(self):
+        """
+        Transpose the matrix.
+        Columns of each row in the result are in ascending order.
+        :return: CSRMatrix
+        """
+        counts = [0] * (self.n_cols + 1)
+        for j in self.indices:
+            counts[j + 1] += 1
+        for j in range(self.n_cols):
+            counts[j + 1] += counts[j]
+        indptr = array('q', counts)
+        # fill positions of each column, which keeps the row order.
+        position = counts[:-1]
+        indices = array('i', bytes(4 * self.nnz))
+        data = array('d', bytes(8 * self.nnz))
+        for i in range(self.n_rows):
+            for k in range(self.indptr[i], self.indptr[i + 1]):
+                j = self.indices[k]
+                indices[position[j]] = i
+                data[position[j]] = self.data[k]
+                position[j] += 1
+        return CSRMatrix(indptr, indices, data, self.n_rows)
+
+
+def weighted_gram_matrix(matrix, weights=None):
+    """
+    Calculate the co-occurrence matrix M * diag(weights) * M^T of a binary matrix M.
+    The diagonal is dropped, so row i only keeps the rows j != i which share a column with i.
+    For each pair (i, j) the weights are summed in the order of the columns of row i,
+    so item similarity comes out bit-identical to the dict loops in :mod:`similarity`.
+
+    Without weights, common columns are counted by Counter in C.
+    Weighted sums stay a Python loop, any bulk sum would change the order of float additions.
+
+    :param matrix: CSRMatrix, only the sparsity pattern is used.
+    :param weights: weight of each column, or None to count common columns.
+    :return: CSRMatrix of co-occurrence
+    """
+    transposed = matrix.transpose()
+    t_indptr, t_indices = transposed.indptr, transposed.indices
+    m_indptr, m_indices = matrix.indptr, matrix.indices
+    indptr, indices, data = array('q', [0]), array('i'), array('d')
+    acc = [0.0] * matrix.n_rows
+    for i in range(matrix.n_rows):
+        columns = [t_indices[t_indptr[k]:t_indptr[k + 1]] for k in m_indices[m_indptr[i]:m_indptr[i + 1]]]
+        if weights is None:
+            counts = Counter(chain.from_iterable(columns))
+            counts.pop(i, None)
+            related = sorted(counts)
+            data.extend(map(counts.__getitem__, related))
+        else:
+            touched = set()
+            for k, column in zip(m_indices[m_indptr[i]:m_indptr[i + 1]], columns):
+                touched.update(column)
+                w = weights[k]
+                for j in column:
+                    acc[j] += w
+            touched.discard(i)
+            related = sorted(touched)
+            data.extend(map(acc.__getitem__, related))
+            for j in touched:
+                acc[j] = 0.0
+            acc[i] = 0.0
+        indices.extend(related)
+        indptr.append(len(indices))
+    return CSRMatrix(indptr, indices, data, matrix.n_rows)
+
+
+def cosine_normalize(matrix, norms):
+    """
+    Scale every value by 1 / sqrt(norms[i] * norms[j]) in place,
+    i.e. diag(1/sqrt(norms)) * M * diag(1/sqrt(norms)).
+    :param matrix: CSRMatrix with n_rows == n_cols
+    :param norms: counts of each row, e.g. how many users have seen a movie.
+    :return: the normalized matrix
+    """
+    indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+    for i in range(matrix.n_rows):
+        start, end = indptr[i], indptr[i + 1]
+        # data[k] / sqrt(norms[i] * norms[indices[k]]) for the whole row at once.
+        data[start:end] = array('d', map(truediv, data[start:end], map(math.sqrt, map(
+            mul, repeat(norms[i]), map(norms.__getitem__, indices[start:end])))))
+    return matrix
+
+
+class SimilarityMatrix(Mapping):
+    """
+    Read-only similarity matrix with the same interface as a dict of dicts.
+    sim_mat[raw_id1][raw_id2] is the similarity of two raw ids.
+    """
+
+    def __init__(self, index: IdIndex, matrix: CSRMatrix):
+        self.index = index
+        self.matrix = matrix
+
+    def to_arrays(self):
+        return {'index': self.index, 'matrix': self.matrix}
+
+    @classmethod
+    def from_arrays(cls, fields):
+        return cls(fields['index'], fields['matrix'])
+
+    def __getitem__(self, raw_id):
+        row_indices, row_data = self.matrix.row(self.index.to_inner(raw_id))
+        return dict(zip(map(self.index.raw_ids.__getitem__, row_indices), row_data))
+
+    def __contains__(self, raw_id):
+        return raw_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class TopKNeighbors:
+    """
+    Fixed-width table of the K most similar neighbours of every row of a similarity matrix.
+    Slot s of row i is ids[i * k + s] and scores[i * k + s], sorted by score descending.
+    Rows with less than K neighbours are padded with id -1.
+    """
+
+    def __init__(self, index: IdIndex, k, ids, scores):
+        self.index = index
+        self.k = k
+        self.ids = ids
+        self.scores = scores
+
+    def to_arrays(self):
+        return {'index': self.index, 'k': self.k, 'ids': self.ids, 'scores': self.scores}
+
+    @classmethod
+    def from_arrays(cls, fields):
+        return cls(fields['index'], fields['k'], fields['ids'], fields['scores'])
+
+    @classmethod
+    def from_similarity(cls, sim_mat, k):
+        """
+        Keep the K most similar neighbours of each row.
+        :param sim_mat: dict of dicts or SimilarityMatrix
+        :param k: number of neighbours to keep.
+        :return: TopKNeighbors
+        """
+        index = sim_mat.index if isinstance(sim_mat, SimilarityMatrix) else IdIndex(sim_mat)
+        ids, scores = array('i'), array('d')
+        for raw_id in index:
+            top_k = top_n_items(sim_mat[raw_id], k)
+            ids.extend([index.to_inner(neighbor) for neighbor, _ in top_k] + [-1] * (k - len(top_k)))
+            scores.extend([score for _, score in top_k] + [0.0] * (k - len(top_k)))
+        return cls(index, k, ids, scores)
+
+    def neighbors(self, raw_id):
+        """
+        Get the K most similar neighbours of a raw id.
+        :param raw_id: raw id
+        :return: list of (neighbour raw id, similarity), most similar first.
+        """
+        start = self.index.to_inner(raw_id) * self.k
+        end = start + self.k
+        raw_ids = self.index.raw_ids
+        return [(raw_ids[j], score) for j, score in zip(self.ids[start:end], self.scores[start:end]) if j >= 0]
+
+    def set_neighbors(self, raw_id, neighbors):
+        """
+        Replace the neighbours of a raw id, the raw id and its neighbours are added if they are new.
+        :param raw_id: raw id
+        :param neighbors: list of (neighbour raw id, similarity), most similar first.
+        :return: None
+        """
+        if not isinstance(self.ids, array):
+            # memory-mapped arrays are read-only.
+            self.ids, self.scores = array('i', self.ids), array('d', self.scores)
+        neighbors = neighbors[:self.k]
+        start = self.index.add(raw_id) * self.k
+        ids = [self.index.add(neighbor) for neighbor, _ in neighbors]
+        missing = len(self.index) * self.k - len(self.ids)
+        if missing > 0:
+            self.ids.extend([-1] * missing)
+            self.scores.extend([0.0] * missing)
+        self.ids[start:start + self.k] = array('i', ids + [-1] * (self.k - len(ids)))
+        self.scores[start:start + self.k] = array('d', [score for _, score in neighbors] + [0.0] * (self.k - len(ids)))
+
+    def __contains__(self, raw_id):
+        return raw_id in self.index
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,310 @@
+# -*- coding = utf-8 -*-
+"""
+Memory-mapped storage of array-backed models.
+
+A model is saved to a versioned directory:
+
+    <name>/CURRENT          name of the current version, e.g. ``v2``
+    <name>/v2/manifest.json class, array types and lengths of the model
+    <name>/v2/*.bin         raw bytes of each array
+    <name>/v2/*.txt         string tables, e.g. raw ids, one per line
+
+Arrays are loaded with mmap as read-only memoryviews,
+so startup is near-instant and processes loading the same model share the same pages.
+A new version is written next to the current one and CURRENT is switched atomically,
+so readers never see a half written model.
+
+Objects are stored if they implement ``to_arrays()`` returning a dict of fields
+and a classmethod ``from_arrays(fields)``. Fields can be arrays, lists of strings,
+JSON values or other such objects. Plain :class:`array.array` is stored too.
+
+:class:`ModelCache` keeps saved models in content-addressed entries,
+one directory per hash of the dataset, split and model parameters,
+and evicts the least recently used entries when the cache outgrows its disk budget.
+"""
+import hashlib
+import importlib
+import json
+import mmap
+import os
+import shutil
+import time
+from array import array
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'
+ENTRY_METADATA = 'entry.json'
+
+# digests of dataset files, keyed by (path, size, mtime), so a file is hashed once per process.
+_file_digests = {}
+
+
+def is_storable(model):
+    return isinstance(model, array) or hasattr(model, 'to_arrays')
+
+
+def _is_array(value):
+    return isinstance(value, (array, memoryview))
+
+
+def _dump(value, path, name):
+    """
+    Write a value to files in path.
+    :return: manifest node of the value.
+    """
+    if _is_array(value):
+        file_name = name + '.bin'
+        with open(os.path.join(path, file_name), 'wb') as f:
+            f.write(value)
+        typecode = value.typecode if isinstance(value, array) else value.format
+        return {'kind': 'array', 'file': file_name, 'typecode': typecode, 'length': len(value)}
+    if hasattr(value, 'to_arrays'):
+        fields = {field: _dump(field_value, path, name + '.' + field)
+                  for field, field_value in value.to_arrays().items()}
+        return {'kind': 'object', 'module': type(value).__module__, 'class': type(value).__name__,
+                'fields': fields}
+    if isinstance(value, list) and all(isinstance(item, str) and '\n' not in item for item in value):
+        file_name = name + '.txt'
+        with open(os.path.join(path, file_name), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(value))
+        return {'kind': 'strings', 'file': file_name, 'length': len(value)}
+    # json.dumps raises TypeError for anything else.
+    json.dumps(value)
+    return {'kind': 'value', 'value': value}
+
+
+def _load(node, path):
+    """
+    Load a value from its manifest node.
+    """
+    kind = node['kind']
+    if kind == 'array':
+        if node['length'] == 0:
+            return array(node['typecode'])
+        with open(os.path.join(path, node['file']), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(buffer).cast(node['typecode'])
+    if kind == 'object':
+        cls = getattr(importlib.import_module(node['module']), node['class'])
+        return cls.from_arrays({field: _load(field_node, path) for field, field_node in node['fields'].items()})
+    if kind == 'strings':
+        if node['length'] == 0:
+            return []
+        with open(os.path.join(path, node['file']), encoding='utf-8') as f:
+            return f.read().split('\n')
+    return node['value']
+
+
+def current_version(directory):
+    """
+    :param directory: model directory.
+    :return: path of the current version, or None if the model has not been saved.
+    """
+    try:
+        with open(os.path.join(directory, CURRENT)) as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    return os.path.join(directory, version)
+
+
+def save(model, directory):
+    """
+    Save model as a new version in directory.
+    The previous version is kept for processes which still map it, older ones are removed.
+    :param model: array or object with to_arrays()
+    :param directory: model directory.
+    :return: path of the new version.
+    """
+    os.makedirs(directory, exist_ok=True)
+    versions = sorted(int(entry[1:]) for entry in os.listdir(directory)
+                      if entry.startswith('v') and entry[1:].isdigit())
+    version = 'v%d' % (versions[-1] + 1 if versions else 1)
+    tmp_path = os.path.join(directory, version + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.mkdir(tmp_path)
+    manifest = {'format': FORMAT_VERSION, 'version': version, 'created': time.time(),
+                'root': _dump(model, tmp_path, 'model')}
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.rename(tmp_path, os.path.join(directory, version))
+    with open(os.path.join(directory, CURRENT + '.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(directory, CURRENT + '.tmp'), os.path.join(directory, CURRENT))
+    for old_version in versions[:-1]:
+        shutil.rmtree(os.path.join(directory, 'v%d' % old_version), ignore_errors=True)
+    return os.path.join(directory, version)
+
+
+def load(directory):
+    """
+    Load the current version of a model with mmap.
+    :param directory: model directory.
+    :return: loaded model
+    """
+    path = current_version(directory)
+    if path is None:
+        raise OSError('There is no model saved in %s' % directory)
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest['format'] != FORMAT_VERSION:
+        raise OSError('Model in %s has unsupported format %s' % (path, manifest['format']))
+    return _load(manifest['root'], path)
+
+
+def file_digest(path):
+    """
+    :param path: path of a file, e.g. the ratings file of a dataset.
+    :return: sha1 hex digest of the file content.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        _file_digests[key] = sha1.hexdigest()
+    return _file_digests[key]
+
+
+def trainset_digest(trainset):
+    """
+    :param trainset: dict of dicts or InteractionStore.
+    :return: sha1 hex digest of the ratings, whatever order users and movies were added in.
+    """
+    sha1 = hashlib.sha1()
+    for user in sorted(trainset):
+        sha1.update(repr((user, sorted(trainset[user].items()))).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def _directory_size(path):
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                # removed by a concurrent save.
+                pass
+    return size
+
+
+class ModelCache:
+    """
+    Content-addressed cache of saved models.
+
+    An entry is the directory root/<key>, where key is the hash of the parts
+    the models depend on. Its entry.json records the key parts, the size in bytes
+    and the last access time, which are used for least recently used eviction.
+    """
+
+    def __init__(self, root='model/cache', disk_budget=None):
+        """
+        :param root: directory of all entries.
+        :param disk_budget: max total bytes of all entries, None for unlimited.
+        """
+        self.root = root
+        self.disk_budget = disk_budget
+
+    @staticmethod
+    def make_key(parts):
+        """
+        :param parts: JSON serializable dict, e.g. dataset digest, split and model parameters.
+        :return: hex digest of the parts.
+        """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def read_metadata(self, key):
+        """
+        :return: metadata dict of the entry, or None if the entry does not exist.
+        """
+        try:
+            with open(os.path.join(self.entry_path(key), ENTRY_METADATA)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_metadata(self, key, metadata):
+        path = os.path.join(self.entry_path(key), ENTRY_METADATA)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(metadata, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def open_entry(self, key, parts):
+        """
+        Create the entry if it does not exist.
+        :param key: key of the entry.
+        :param parts: key parts, recorded in metadata.
+        :return: path of the entry.
+        """
+        path = self.entry_path(key)
+        os.makedirs(path, exist_ok=True)
+        if self.read_metadata(key) is None:
+            now = time.time()
+            self.write_metadata(key, {'key': key, 'parts': parts, 'created': now, 'last_used': now, 'size': 0})
+        return path
+
+    def touch(self, key):
+        """
+        Mark the entry as used now.
+        """
+        metadata = self.read_metadata(key)
+        if metadata is not None:
+            metadata['last_used'] = time.time()
+            self.write_metadata(key, metadata)
+
+    def update_size(self, key):
+        """
+        Recount the bytes of the entry after a model is saved into it.
+        :return: size of the entry.
+        """
+        metadata = self.read_metadata(key)
+        if metadata is None:
+            return 0
+        metadata['size'] = _directory_size(self.entry_path(key))
+        metadata['last_used'] = time.time()
+        self.write_metadata(key, metadata)
+        return metadata['size']
+
+    def entries(self):
+        """
+        :return: metadata of all entries, least recently used first.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        entries = [self.read_metadata(key) for key in os.listdir(self.root)]
+        return sorted((metadata for metadata in entries if metadata is not None),
+                      key=lambda metadata: metadata['last_used'])
+
+    def total_size(self):
+        return sum(metadata['size'] for metadata in self.entries())
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used entries until the cache fits in the disk budget.
+        :param keep: keys which must not be removed, e.g. the entry being saved.
+        :return: list of removed keys.
+        """
+        if self.disk_budget is None:
+            return []
+        entries = self.entries()
+        total = sum(metadata['size'] for metadata in entries)
+        removed = []
+        for metadata in entries:
+            if total <= self.disk_budget:
+                break
+            if metadata['key'] in keep:
+                continue
+            self.remove(metadata['key'])
+            total -= metadata['size']
+            removed.append(metadata['key'])
+        return removed
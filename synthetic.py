@@ -0,0 +1,138 @@
+# -*- coding = utf-8 -*-
+"""
+Generate MovieLens-shaped ratings files for scale testing.
+
+Item popularity and user activity follow power laws:
+the item of popularity rank r is drawn with weight 1 / r ** item_exponent,
+and the user of activity rank r rates about min_ratings + share of the rest
+in proportion to 1 / r ** user_exponent, at most all items.
+Ranks are shuffled over ids, so popular items and heavy users are spread over all ids.
+Rating values follow the distribution of ml-100k.
+
+Ratings are written user by user in the format of ml-1m (``::``) or ml-100k (tab),
+so only the items of one user are in memory and files of 100M ratings can be generated.
+"""
+import itertools
+import json
+import os
+import random
+
+from utils import LogTime
+
+# ratio of ratings 1 to 5 in ml-100k.
+RATING_WEIGHTS = (6.1, 11.4, 27.1, 34.2, 21.2)
+# the time range of ml-100k, from 1997-09-20 to 1998-04-23.
+TIMESTAMP_RANGE = (874724710, 893286638)
+SPEC_SUFFIX = '.spec.json'
+
+
+def power_law_weights(n, exponent):
+    """
+    :return: weight 1 / r ** exponent of ranks r = 1..n.
+    """
+    return [rank ** -exponent for rank in range(1, n + 1)]
+
+
+def user_activities(n_users, n_items, n_ratings, exponent, min_ratings=1):
+    """
+    Split n_ratings over users by a power law of user activity.
+    A user rates at most all items, ratings over that are split again over the other users.
+    :return: ratings number of each activity rank, the most active first.
+    """
+    min_ratings = min(min_ratings, n_items)
+    weights = power_law_weights(n_users, exponent)
+    activities = [float(min_ratings)] * n_users
+    rest = max(0, min(n_ratings, n_items * n_users) - min_ratings * n_users)
+    while rest >= 1:
+        uncapped = [u for u in range(n_users) if activities[u] < n_items]
+        total_weight = sum(weights[u] for u in uncapped)
+        for u in uncapped:
+            activities[u] = min(n_items, activities[u] + rest * weights[u] / total_weight)
+        rest = min(n_ratings, n_items * n_users) - sum(activities)
+    return [int(round(activity)) for activity in activities]
+
+
+def sample_distinct(rng, items, cum_weights, k):
+    """
+    Draw k distinct items with probability in proportion to their weights.
+    :param rng: random.Random
+    :param items: items to draw.
+    :param cum_weights: cumulative weights of items.
+    :param k: number of items.
+    :return: list of k items in the order they are drawn.
+    """
+    if k >= len(items):
+        return list(items)
+    chosen = {}
+    for _ in range(8):
+        for item in rng.choices(items, cum_weights=cum_weights, k=int((k - len(chosen)) * 1.1) + 1):
+            chosen[item] = None
+            if len(chosen) == k:
+                return list(chosen)
+    # the tail of a steep power law is rarely drawn, the last items are drawn uniformly.
+    rest = [item for item in items if item not in chosen]
+    return list(chosen) + rng.sample(rest, k - len(chosen))
+
+
+def generate_ratings(path, n_users, n_items, density, sep='::', seed=0, item_exponent=0.6, user_exponent=0.4,
+                     min_ratings=1):
+    """
+    Write a synthetic ratings file, one ``user sep item sep rating sep timestamp`` line per rating.
+    The file is written aside and renamed, so readers never see half of it.
+    :param path: path of the ratings file.
+    :param n_users: number of users, ids are 1..n_users.
+    :param n_items: number of items, ids are 1..n_items.
+    :param density: ratio of rated (user, item) pairs.
+    :param sep: '::' as ml-1m or a tab as ml-100k.
+    :param seed: random seed, the same parameters always give the same file.
+    :param item_exponent: exponent of the power law of item popularity.
+    :param user_exponent: exponent of the power law of user activity.
+    :param min_ratings: ratings number of the least active users.
+    :return: number of ratings written.
+    """
+    rng = random.Random(seed)
+    items = list(range(1, n_items + 1))
+    rng.shuffle(items)
+    cum_weights = list(itertools.accumulate(power_law_weights(n_items, item_exponent)))
+    activities = user_activities(n_users, n_items, int(density * n_users * n_items), user_exponent, min_ratings)
+    rng.shuffle(activities)
+    rating_cum_weights = list(itertools.accumulate(RATING_WEIGHTS))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    generate_time = LogTime(print_step=max(1, n_users // 10), words='generate users')
+    n_ratings = 0
+    with open(path + '.tmp', 'w') as f:
+        for user, activity in enumerate(activities, 1):
+            movies = sample_distinct(rng, items, cum_weights, activity)
+            rates = rng.choices((1, 2, 3, 4, 5), cum_weights=rating_cum_weights, k=activity)
+            f.writelines('%d%s%d%s%d%s%d\n' % (user, sep, movie, sep, rate, sep, rng.randint(*TIMESTAMP_RANGE))
+                         for movie, rate in zip(movies, rates))
+            n_ratings += activity
+            generate_time.count_time()
+    os.replace(path + '.tmp', path)
+    generate_time.finish()
+    print('Generate %d ratings of %d users and %d items to %s success.' % (n_ratings, n_users, n_items, path))
+    return n_ratings
+
+
+def ensure_ratings(path, spec):
+    """
+    Generate the ratings file unless it exists and was generated with the same spec.
+    The spec is saved next to the file.
+    :param path: path of the ratings file.
+    :param spec: dict of keyword arguments of :func:`generate_ratings`.
+    :return: None
+    """
+    spec_path = path + SPEC_SUFFIX
+    if os.path.isfile(path):
+        try:
+            with open(spec_path) as f:
+                if json.load(f) == spec:
+                    return
+        except (OSError, ValueError):
+            pass
+    generate_ratings(path, **spec)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, indent=1)
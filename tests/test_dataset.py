@@ -0,0 +1,112 @@
+import collections
+import random
+
+import pytest
+
+import dataset
+from dataset import BuiltinDataset, DataSet
+
+
+def register(tmp_path, monkeypatch, lines):
+    path = tmp_path / 'ratings.dat'
+    path.write_text(''.join('::'.join(map(str, line)) + '\n' for line in lines))
+    monkeypatch.setitem(dataset.BUILTIN_DATASETS, 'test-ratings',
+                        BuiltinDataset(url=None, path=str(path), sep='::', reader_params={}))
+    return str(path) + dataset.COLUMNS_CACHE_SUFFIX
+
+
+def test_load_columns_half_star_ratings(tmp_path, monkeypatch):
+    register(tmp_path, monkeypatch, [(1, 10, 3.5, 100), (1, 20, 4, 101), (2, 10, 0.5, 102)])
+    for _ in range(2):
+        # parsed first, then read from the cache.
+        columns = DataSet.load_columns('test-ratings')
+        assert list(columns.rating) == [3.5, 4.0, 0.5]
+    train, _ = DataSet.split_columns(columns, test_size=0.0)
+    assert train == {'1': {'10': 3.5, '20': 4}, '2': {'10': 0.5}}
+    assert type(train['1']['20']) is int
+
+
+def test_load_columns_truncated_cache(tmp_path, monkeypatch):
+    cache_path = register(tmp_path, monkeypatch, [(1, 10, 3, 100), (2, 20, 5, 101)])
+    DataSet.load_columns('test-ratings')
+    with open(cache_path, 'rb') as f:
+        content = f.read()
+    for size in (0, dataset.COLUMNS_CACHE_HEADER.size - 1, len(content) - 1):
+        with open(cache_path, 'wb') as f:
+            f.write(content[:size])
+        assert list(DataSet.load_columns('test-ratings').user) == [1, 2]
+
+
+def test_compact_half_star_ratings():
+    store = dataset.InteractionStore.from_dict({'1': {'10': 3.5, '20': 4}})
+    assert dict(store['1']) == {'10': 3.5, '20': 4.0}
+    assert dataset.InteractionStore.from_dict({'1': {'10': 3}}).ratings.typecode == 'b'
+
+
+def columns_of(n_users, n_ratings):
+    rows = [(user, item) for user in range(1, n_users + 1) for item in range(1, n_ratings + 1)]
+    return dataset.RatingColumns(user=[user for user, _ in rows], item=[item for _, item in rows],
+                                 rating=[3.0] * len(rows), timestamp=list(range(len(rows))))
+
+
+def test_split_user_keeps_a_training_rating():
+    train, test = DataSet.split_columns(columns_of(50, 2), strategy='user', test_size=0.8)
+    assert all(len(train[user]) == 1 for user in map(str, range(1, 51)))
+    assert sum(map(len, test.values())) == 50
+
+
+def test_random_mask():
+    assert dataset.random_mask(random.Random(0), 100, 0.0) == bytearray(100)
+    assert dataset.random_mask(random.Random(0), 100, 1.0) == bytearray(b'\x01' * 100)
+    mask = dataset.random_mask(random.Random(0), 100000, 0.3)
+    assert abs(sum(mask) / 100000 - 0.3) < 0.01
+    assert dataset.random_mask(random.Random(1), 1000, 0.3) == dataset.random_mask(random.Random(1), 1000, 0.3)
+
+
+def test_load_columns_in_chunks(tmp_path, monkeypatch):
+    lines = [(user, item, item % 5 + 1, user * 100 + item) for user in range(1, 8) for item in range(1, 13)]
+    register(tmp_path, monkeypatch, lines)
+    # chunks end in the middle of lines and fields.
+    monkeypatch.setattr(dataset, 'COLUMNS_CHUNK_SIZE', 7)
+    columns = DataSet.load_columns('test-ratings', use_cache=False)
+    assert list(zip(columns.user, columns.item, columns.rating, columns.timestamp)) == lines
+
+
+def test_load_dataset_from_columns(tmp_path, monkeypatch):
+    register(tmp_path, monkeypatch, [(1, 10, 3, 100), (2, 20, 4.5, 101)])
+    assert DataSet.load_dataset('test-ratings') == [('1', '10', 3), ('2', '20', 4.5)]
+
+
+def test_stream_split_matches_train_test_split():
+    rng = random.Random(3)
+    ratings = [(str(rng.randrange(40)), str(rng.randrange(60)), str(rng.randint(1, 5))) for _ in range(2000)]
+    chunks = [ratings[k:k + 300] for k in range(0, len(ratings), 300)]
+    split = DataSet.train_test_split_stream(chunks, test_size=0.3, seed=5)
+    train, test = DataSet.train_test_split(ratings, test_size=0.3, seed=5)
+    assert isinstance(split.trainset, dataset.InteractionStore)
+    assert split.trainset == train and split.testset == test
+    compact_train, _ = DataSet.train_test_split(ratings, test_size=0.3, seed=5, compact=True)
+    assert list(split.trainset.movie_index) == list(compact_train.movie_index)
+    assert split.trainset_len == sum(map(len, train.values()))
+    assert split.movie_popular == collections.Counter(movie for movies in train.values() for movie in movies)
+
+
+def test_compact_lookup_in_unsorted_rows():
+    trainset = {'1': {'30': 1, '10': 2, '20': 3}, '2': {'20': 4, '40': 5}}
+    store = dataset.InteractionStore.from_dict(trainset)
+    assert all(store[user][movie] == rating for user, movies in trainset.items() for movie, rating in movies.items())
+    assert '40' not in store['1'] and '10' not in store['2']
+    with pytest.raises(KeyError):
+        store['2']['10']
+
+
+def test_split_columns_compact_matches_dicts():
+    rng = random.Random(2)
+    columns = dataset.RatingColumns(user=[rng.randrange(30) for _ in range(1000)],
+                                    item=[rng.randrange(50) for _ in range(1000)],
+                                    rating=[rng.choice([1.0, 2.5, 4.0]) for _ in range(1000)],
+                                    timestamp=list(range(1000)))
+    train, test = DataSet.split_columns(columns, test_size=0.3, seed=4)
+    compact_train, compact_test = DataSet.split_columns(columns, test_size=0.3, seed=4, compact=True)
+    assert isinstance(compact_train, dataset.InteractionStore)
+    assert compact_train == train and compact_test == test
@@ -0,0 +1,20 @@
+import instrument
+
+
+def test_timed_keeps_function_metadata():
+    @instrument.timed('test.double')
+    def double(x):
+        """Double x."""
+        return 2 * x
+
+    assert double.__name__ == 'double'
+    assert double.__doc__ == 'Double x.'
+    assert double.__wrapped__(2) == 4
+    instrument.reset()
+    instrument.enable()
+    try:
+        assert double(3) == 6
+        assert instrument.snapshot()['spans']['test.double']['count'] == 1
+    finally:
+        instrument.disable()
+        instrument.reset()
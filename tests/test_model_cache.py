@@ -0,0 +1,52 @@
+import os
+import random
+
+import dataset
+import main
+import utils
+from dataset import BuiltinDataset, DataSet, InteractionStore
+from storage import ModelCache
+
+
+def test_model_key_depends_on_trainset(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path)))
+    monkeypatch.setattr(utils.ModelManager, 'dataset', {})
+    monkeypatch.setattr(utils.ModelManager, 'split', {})
+    params = {'model': 'MostPopular'}
+    trainset = {'1': {'10': 5, '20': 3}, '2': {'10': 4}}
+    reordered = {'2': {'10': 4}, '1': {'20': 3, '10': 5}}
+    changed = {'1': {'10': 5, '20': 3}, '2': {'10': 4, '30': 1}}
+    key = utils.ModelManager(params=params, trainset=trainset).key
+    assert utils.ModelManager(params=params, trainset=reordered).key == key
+    assert utils.ModelManager(params=params, trainset=InteractionStore.from_dict(trainset)).key == key
+    assert utils.ModelManager(params=params, trainset=changed).key != key
+    assert utils.ModelManager(params={'model': 'Random'}, trainset=trainset).key != key
+
+
+def test_split_seed():
+    ratings = [(str(user), str(movie), 3) for user in range(20) for movie in range(20)]
+    first = DataSet.train_test_split(ratings, test_size=0.3, seed=1)
+    random.random()
+    assert DataSet.train_test_split(ratings, test_size=0.3, seed=1) == first
+    assert DataSet.train_test_split(ratings, test_size=0.3, seed=2) != first
+
+
+def test_clean_removes_only_current_entries(tmp_path, monkeypatch):
+    path = tmp_path / 'ratings.dat'
+    path.write_text(''.join('%d::%d::3::0\n' % (user, movie) for user in range(20) for movie in range(user, user + 5)))
+    monkeypatch.setitem(dataset.BUILTIN_DATASETS, 'test-ratings',
+                        BuiltinDataset(url=None, path=str(path), sep='::', reader_params={}))
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path / 'model')))
+    monkeypatch.setattr(utils.ModelManager, 'dataset', {})
+    monkeypatch.setattr(utils.ModelManager, 'split', {})
+    model, _ = main.fit_model('MostPopular', 'test-ratings', test_size=0.2)
+    other, _ = main.fit_model('Random', 'test-ratings', test_size=0.2)
+    split_key = utils.ModelManager('test-ratings', 0.2, dataset_path=str(path), compact=False, seed=0,
+                                   strategy='random').key
+    model_key = utils.ModelManager(params=model.cache_params(), trainset=model.trainset).key
+    other_key = utils.ModelManager(params=other.cache_params(), trainset=other.trainset).key
+    removed = []
+    monkeypatch.setattr(utils.ModelManager.cache, 'remove', removed.append)
+    main.fit_model('MostPopular', 'test-ratings', test_size=0.2, clean=True)
+    assert removed == [split_key, model_key]
+    assert other_key not in removed and os.path.isdir(utils.ModelManager.cache.entry_path(other_key))
@@ -0,0 +1,57 @@
+import random
+
+import pytest
+
+import utils
+from ItemCF import ItemBasedCF
+from UserCF import UserBasedCF
+from sparse_matrix import TopKNeighbors
+from storage import ModelCache
+
+
+@pytest.fixture(autouse=True)
+def model_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path)))
+
+
+def random_trainset(seed=0):
+    rng = random.Random(seed)
+    return {str(user): {str(movie): rng.randint(1, 5) for movie in rng.sample(range(40), rng.randint(1, 15))}
+            for user in range(30)}
+
+
+def check_neighbors(sim_mat, neighbors, k):
+    """
+    Neighbours are the top-K of each similarity row, ties at the K-th score may be kept in any order.
+    """
+    for row in sim_mat:
+        expected = dict(sim_mat[row].items())
+        actual = neighbors.neighbors(row)
+        assert [score for _, score in actual] == pytest.approx(sorted(expected.values(), reverse=True)[:k])
+        assert all(expected[neighbor] == pytest.approx(score) for neighbor, score in actual)
+
+
+def test_top_k_neighbors():
+    sim_mat = {'a': {'b': 0.5, 'c': 0.9, 'd': 0.1}, 'b': {'a': 0.5}, 'c': {'a': 0.9}, 'd': {'a': 0.1}}
+    neighbors = TopKNeighbors.from_similarity(sim_mat, 2)
+    assert neighbors.neighbors('a') == [('c', 0.9), ('b', 0.5)]
+    assert neighbors.neighbors('b') == [('a', 0.5)]
+    assert 'd' in neighbors and 'e' not in neighbors and len(neighbors) == 4
+
+
+def test_item_cf_neighbors():
+    trainset = random_trainset()
+    model = ItemBasedCF(k_sim_movie=5, save_model=False)
+    model.fit(trainset)
+    check_neighbors(model.movie_sim_mat, model.movie_neighbors, 5)
+    movies = model.recommend('0')
+    assert len(movies) == 10 and not set(movies) & set(trainset['0'])
+
+
+def test_user_cf_neighbors():
+    trainset = random_trainset()
+    model = UserBasedCF(k_sim_user=5, save_model=False)
+    model.fit(trainset)
+    check_neighbors(model.user_sim_mat, model.user_neighbors, 5)
+    movies = model.recommend('0')
+    assert len(movies) == 10 and not set(movies) & set(trainset['0'])
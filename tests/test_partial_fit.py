@@ -0,0 +1,119 @@
+import copy
+import random
+
+import pytest
+
+import utils
+from ItemCF import ItemBasedCF
+from LFM import LFM, ArrayLFM
+from UserCF import UserBasedCF
+from storage import ModelCache
+
+
+@pytest.fixture(autouse=True)
+def model_cache(tmp_path):
+    cache, dataset, split = utils.ModelManager.cache, utils.ModelManager.dataset, utils.ModelManager.split
+    utils.ModelManager.cache = ModelCache(str(tmp_path / 'cache'))
+    utils.ModelManager('partial-fit-test', 0.1)
+    yield
+    utils.ModelManager.cache, utils.ModelManager.dataset, utils.ModelManager.split = cache, dataset, split
+
+
+def make_ratings(n_users=60, n_movies=40, n_ratings=8, seed=0):
+    rng = random.Random(seed)
+    movies = [str(movie) for movie in range(n_movies)]
+    return {str(user): {movie: rng.randint(1, 5) for movie in rng.sample(movies, n_ratings)}
+            for user in range(n_users)}
+
+
+def make_events(trainset, n=30, seed=1):
+    rng = random.Random(seed)
+    movies = sorted({movie for ratings in trainset.values() for movie in ratings})
+    events = []
+    for user in rng.sample(sorted(trainset), n):
+        movie = rng.choice([movie for movie in movies if movie not in trainset[user]])
+        events.append((user, movie, rng.randint(1, 5)))
+    return events + [('new-user', movies[0], 5), ('new-user', 'new-movie', 4)]
+
+
+def with_events(trainset, events):
+    ratings = copy.deepcopy(trainset)
+    for user, movie, rating in events:
+        ratings.setdefault(user, {})[movie] = rating
+    return ratings
+
+
+def assert_same_similarity(a, b):
+    assert set(a) == set(b)
+    for key in b:
+        assert set(a[key]) == set(b[key])
+        for other in b[key]:
+            assert a[key][other] == pytest.approx(b[key][other])
+
+
+@pytest.mark.parametrize('use_iif_similarity', [False, True])
+def test_models_sharing_trainset(use_iif_similarity):
+    trainset = make_ratings()
+    original = copy.deepcopy(trainset)
+    events = make_events(trainset)
+    item_cf = ItemBasedCF(save_model=False)
+    item_cf.fit(trainset)
+    user_cf = UserBasedCF(use_iif_similarity=use_iif_similarity, save_model=False)
+    user_cf.fit(trainset)
+
+    item_cf.partial_fit(events)
+    user_cf.partial_fit(events)
+    assert trainset == original
+
+    refit = UserBasedCF(use_iif_similarity=use_iif_similarity, save_model=False)
+    refit.fit(with_events(original, events))
+    assert_same_similarity(user_cf.user_sim_mat, refit.user_sim_mat)
+    assert user_cf.user_popular == {user: len(movies) for user, movies in refit.trainset.items()}
+
+
+def test_rebuild_keeps_trainset():
+    trainset = make_ratings()
+    original = copy.deepcopy(trainset)
+    events = make_events(trainset)
+    user_cf = UserBasedCF(save_model=False, rebuild_every=10)
+    user_cf.fit(trainset)
+    user_cf.partial_fit(events)
+    assert trainset == original
+    assert user_cf.trainset == with_events(original, events)
+
+
+@pytest.mark.parametrize('model_class', [LFM, ArrayLFM])
+def test_fold_in_keeps_trainset(model_class):
+    trainset = make_ratings()
+    original = copy.deepcopy(trainset)
+    model = model_class(4, 1, 0.02, 0.01, save_model=False)
+    model.fit(trainset)
+    model.fold_in_user('new-user', {'0': 1, '1': 1})
+    model.fold_in_item('new-movie', {'0': 1, '1': 1})
+    assert trainset == original
+    assert model.trainset['new-user'] == {'0': 1, '1': 1}
+    assert model.trainset['0']['new-movie'] == 1
+
+    warm = with_events(original, [('0', 'new-movie', 1)])
+    model.warm_start(warm)
+    model.fold_in_user('another-user', {'2': 1})
+    assert 'another-user' not in warm
+
+
+def test_item_cf_without_similarity_matrix():
+    trainset = make_ratings()
+    events = make_events(trainset)
+    kept = ItemBasedCF(save_model=False)
+    kept.fit(trainset)
+    dropped = ItemBasedCF(keep_similarity_matrix=False)
+    dropped.fit(trainset)
+    assert dropped.movie_sim_mat is None
+    # loaded from the cache without the similarity matrix.
+    loaded = ItemBasedCF(keep_similarity_matrix=False)
+    loaded.fit(trainset)
+    assert loaded.movie_sim_mat is None
+    assert loaded.recommend('0') == kept.recommend('0')
+
+    kept.partial_fit(events)
+    loaded.partial_fit(events)
+    assert_same_similarity(loaded.movie_sim_mat, kept.movie_sim_mat)
@@ -0,0 +1,33 @@
+import pytest
+
+import main
+import utils
+from storage import ModelCache
+
+
+@pytest.mark.parametrize('model_name', ['UserCF', 'ItemCF', 'LFM', 'LFM-Array', 'Random'])
+def test_unknown_users_get_empty_lists(model_name, tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path)))
+    trainset = {str(user): {str(movie): 3 for movie in range(user, user + 5)} for user in range(20)}
+    model = main.create_model(model_name)
+    model.save_model = False
+    model.fit(trainset)
+    movies, scores = model.recommend_batch(['1', 'unknown', '2'], n=3)
+    assert movies[1] == [] and scores[1] == []
+    assert len(movies[0]) == len(scores[0]) == 3
+    assert len(movies[2]) == len(scores[2]) == 3
+
+
+def test_most_popular_falls_back_to_popularity_for_unknown_users(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path)))
+    trainset = {str(user): {str(movie): 3 for movie in range(user, user + 5)} for user in range(20)}
+    model = main.create_model('MostPopular')
+    model.save_model = False
+    model.fit(trainset)
+    popular = [movie for movie, _ in model.movie_popular_sort[:3]]
+    movies, scores = model.recommend_batch(['1', 'unknown'], n=3)
+    assert movies[1] == popular
+    assert scores[1] == [model.movie_popular[movie] for movie in popular]
+    assert len(movies[0]) == 3 and not set(movies[0]) & set(trainset['1'])
+    model.n_rec_movie = 3
+    assert model.recommend('unknown') == popular
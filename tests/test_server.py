@@ -0,0 +1,45 @@
+import json
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+import utils
+from most_popular import MostPopular
+from server import RecommendService, make_server
+from storage import ModelCache
+
+
+@pytest.fixture
+def connection(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.ModelManager, 'cache', ModelCache(str(tmp_path)))
+    model = MostPopular(save_model=False)
+    model.fit({'1': {'10': 5}, '2': {'10': 4, '20': 3}, '3': {'30': 1}})
+    server = make_server(RecommendService(model, 'MostPopular'), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection = HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+    yield connection
+    connection.close()
+    server.shutdown()
+    server.server_close()
+
+
+def get(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.mark.parametrize('n', ['0', '-1', 'x', '1.5'])
+def test_recommend_rejects_bad_n(connection, n):
+    status, body = get(connection, '/recommend?user=1&n=' + n)
+    assert status == 400
+    assert 'n must be' in body['error']
+
+
+def test_recommend(connection):
+    status, body = get(connection, '/recommend?user=1&n=1')
+    assert status == 200
+    assert body['movies'] == ['20']
+    assert get(connection, '/recommend?user=unknown')[0] == 404
@@ -0,0 +1,32 @@
+import random
+
+import pytest
+
+import similarity
+
+
+def random_trainset(seed=0):
+    rng = random.Random(seed)
+    return {str(user): {str(movie): rng.randint(1, 5) for movie in rng.sample(range(40), rng.randint(1, 15))}
+            for user in range(30)}
+
+
+def as_dicts(sim_mat):
+    return {row: dict(sim_mat[row].items()) for row in sim_mat}
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+@pytest.mark.parametrize('dict_engine, sparse_engine', [
+    (similarity.calculate_item_similarity, similarity.calculate_item_similarity_sparse),
+    (similarity.calculate_user_similarity, similarity.calculate_user_similarity_sparse),
+])
+def test_sparse_similarity_equals_dict_similarity(dict_engine, sparse_engine, weighted):
+    trainset = random_trainset()
+    expected, popular, count = dict_engine(trainset, weighted)
+    actual, sparse_popular, sparse_count = sparse_engine(trainset, weighted)
+    expected, actual = as_dicts(expected), as_dicts(actual)
+    assert {row: set(values) for row, values in actual.items() if values} == \
+           {row: set(values) for row, values in expected.items() if values}
+    for row, values in expected.items():
+        assert actual[row] == pytest.approx(values, rel=1e-6)
+    assert dict(sparse_popular) == dict(popular) and sparse_count == count
@@ -6,11 +6,14 @@ Created on 2018-04-16
 
 @author: fuxuemingzhu
 """
+import heapq
 import time
 import pickle
 
 import os
-import shutil
+
+import storage
+from storage import ModelCache, file_digest, is_storable, trainset_digest
 
 
 class LogTime:
@@ -62,56 +65,147 @@ class LogTime:
         return time.time() - self.start_time
 
 
+def top_n_items(scores: dict, n):
+    """
+    Select the N best scored items with a heap instead of sorting all candidates.
+    Items with the same score are ordered by item id, so results are stable across runs.
+    :param scores: dict of {item: score}
+    :param n: how many items to select.
+    :return: list of (item, score), best first.
+    """
+    if len(scores) > n > 0:
+        # find the N-th best score on plain floats first, then only order the items above it.
+        kth = heapq.nlargest(n, scores.values())[-1]
+        candidates = [item_score for item_score in scores.items() if item_score[1] >= kth]
+    else:
+        candidates = scores.items()
+    return sorted(candidates, key=lambda item_score: (-item_score[1], item_score[0]))[:n]
+
+
+def top_n_indices(scores, n, excluded=()):
+    """
+    Select the indices of the N best scores in a list or array of scores.
+    Indices with the same score are ordered by index.
+    :param scores: score of each index.
+    :param n: how many indices to select.
+    :param excluded: indices which can't be selected, e.g. watched movies.
+    :return: list of indices, best first.
+    """
+    candidates = (i for i in range(len(scores)) if i not in excluded) if excluded else range(len(scores))
+    return heapq.nlargest(n, candidates, key=scores.__getitem__)
+
+
+def copy_trainset(trainset):
+    """
+    Copy a trainset to dicts owned by the caller.
+    Incremental updates write new ratings to the trainset of a model,
+    which must not change the trainset passed to fit, other models can share it.
+    :param trainset: dict of dicts or InteractionStore
+    :return: dict of {user: {movie: rating}}
+    """
+    return {user: dict(movies.items()) for user, movies in trainset.items()}
+
+
+def percentile(sorted_values, q):
+    """
+    :param sorted_values: values in ascending order.
+    :param q: percentile between 0 and 100.
+    :return: nearest-rank percentile
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+
 class ModelManager:
     """
     Model manager is designed to load and save all models.
-    No matter what dataset name.
+    Models are saved in a content-addressed cache, see :class:`storage.ModelCache`.
+    The key of trainset and testset is the hash of the dataset file and the split parameters, seed included.
+    The key of a model is the hash of its trainset content and its hyper-parameters,
+    so a model is only reused with the same ratings and parameters,
+    whichever dataset or split they came from, and stays valid when the trainset entry is evicted.
     """
-    # This dataset_name belongs to the whole class.
-    # So it should be init for only once.
-    path_name = ''
-
-    @classmethod
-    def __init__(cls, dataset_name=None, test_size=0.3):
+    # The dataset and split belong to the whole class.
+    # They are set by ModelManager(dataset_name, ...) before the trainset is split.
+    dataset = {}
+    split = {}
+    cache = ModelCache('model/cache', disk_budget=1 << 30)
+
+    def __init__(self, dataset_name=None, test_size=0.3, params=None, dataset_path=None, disk_budget=None,
+                 trainset=None, **split_params):
         """
-        cls.dataset_name should only init for only once.
-        :param dataset_name:
+        :param dataset_name: set the dataset of the whole class if given.
+        :param test_size: split parameter, used with dataset_name.
+        :param params: hyper-parameters of the model, e.g. {'model': 'ItemCF', 'use_iuf_similarity': True}.
+                       None for the artifacts shared by all models, e.g. trainset and testset.
+        :param dataset_path: ratings file, whose content hash is part of the key.
+        :param disk_budget: max bytes of the whole cache.
+        :param trainset: trainset the model is fitted on, whose digest replaces the dataset and split in the key.
+        :param split_params: other split parameters, e.g. seed and compact.
         """
-        if not cls.path_name:
-            cls.path_name = "model/" + dataset_name + '-testsize' + str(test_size)
+        if dataset_name is not None:
+            ModelManager.dataset = {'name': dataset_name,
+                                    'digest': file_digest(dataset_path) if dataset_path else None}
+            ModelManager.split = dict(split_params, test_size=test_size)
+        if disk_budget is not None:
+            ModelManager.cache.disk_budget = disk_budget
+        if trainset is not None:
+            self.parts = {'trainset': trainset_digest(trainset), 'params': params or {}}
+        else:
+            self.parts = {'dataset': self.dataset, 'split': self.split, 'params': params or {}}
+        self.key = ModelCache.make_key(self.parts)
+        self.path_name = self.cache.entry_path(self.key)
 
     def save_model(self, model, save_name: str):
         """
-        Save model to model/ dir.
+        Save model to its cache entry in model/ dir.
+        Array-backed models are saved as a versioned directory of raw arrays, see :mod:`storage`.
+        Other models are pickled.
+        Least recently used entries are evicted if the cache is over its disk budget.
         :param model: source model
         :param save_name: model saved name.
         :return: None
         """
-        if 'pkl' not in save_name:
-            save_name += '.pkl'
-        if not os.path.exists('model'):
-            os.mkdir('model')
-        pickle.dump(model, open(self.path_name + "-%s" % save_name, "wb"))
+        self.cache.open_entry(self.key, self.parts)
+        if is_storable(model):
+            storage.save(model, os.path.join(self.path_name, save_name.replace('.pkl', '')))
+        else:
+            if 'pkl' not in save_name:
+                save_name += '.pkl'
+            # written aside and renamed, so a process reloading the model never reads half a pickle.
+            path = os.path.join(self.path_name, save_name)
+            with open(path + '.tmp', "wb") as f:
+                pickle.dump(model, f)
+            os.replace(path + '.tmp', path)
+        self.cache.update_size(self.key)
+        for key in self.cache.evict(keep={self.key}):
+            print('Evict model cache entry %s.' % key)
 
     def load_model(self, model_name: str):
         """
-        Load model from model/ dir via model name.
+        Load model from its cache entry via model name.
+        Array-backed models are memory-mapped, the pickled model is the fallback.
         :param model_name:
         :return: loaded model
         """
-        if 'pkl' not in model_name:
-            model_name += '.pkl'
-        if not os.path.exists(self.path_name + "-%s" % model_name):
-            raise OSError('There is no model named %s in model/ dir' % model_name)
-        return pickle.load(open(self.path_name + "-%s" % model_name, "rb"))
-
-    @staticmethod
-    def clean_workspace(clean=False):
+        directory = os.path.join(self.path_name, model_name.replace('.pkl', ''))
+        if storage.current_version(directory) is not None:
+            model = storage.load(directory)
+        else:
+            if 'pkl' not in model_name:
+                model_name += '.pkl'
+            if not os.path.exists(os.path.join(self.path_name, model_name)):
+                raise OSError('There is no model named %s in %s' % (model_name, self.path_name))
+            with open(os.path.join(self.path_name, model_name), "rb") as f:
+                model = pickle.load(f)
+        self.cache.touch(self.key)
+        return model
+
+    def clean_entry(self):
         """
-        Clean the whole workspace.
-        All File in model/ dir will be removed.
-        :param clean: Boolean. Clean workspace or not.
+        Remove all models saved with the same key as this manager,
+        i.e. the same dataset and split, or the same trainset, and the same parameters.
         :return: None
         """
-        if clean and os.path.exists('model'):
-            shutil.rmtree('model')
+        self.cache.remove(self.key)